@@ -7,7 +7,12 @@
 # ----------------------------------------------------------------------------
 
 from ._tabulate import tabulate
-from ._distance import distance_matrix
+from ._distance import (distance_matrix, distance_matrices,
+                        categorical_distance_matrix, metadata_distance_matrix,
+                        gower_distance_matrix, haversine_distance_matrix,
+                        sparse_distance_matrix, grouped_distance_matrices,
+                        temporal_distance_matrix, update_distance_matrix)
+from ._mantel import mantel
 from ._random import shuffle_groups
 from ._merge import merge
 from ._version import get_versions
@@ -15,4 +20,9 @@ from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
-__all__ = ['tabulate', 'distance_matrix', 'shuffle_groups', 'merge']
+__all__ = ['tabulate', 'distance_matrix', 'distance_matrices',
+           'categorical_distance_matrix', 'metadata_distance_matrix',
+           'gower_distance_matrix', 'haversine_distance_matrix',
+           'sparse_distance_matrix', 'grouped_distance_matrices',
+           'temporal_distance_matrix', 'update_distance_matrix',
+           'mantel', 'shuffle_groups', 'merge']
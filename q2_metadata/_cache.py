@@ -0,0 +1,65 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+# Bump when the layout of cached files or the meaning of a key changes, so
+# that stale entries are never read.
+CACHE_VERSION = 1
+
+
+def cache_key(series, **settings):
+    """Hash of a metadata column's IDs, values and the distance settings."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': CACHE_VERSION,
+                              'settings': settings},
+                             sort_keys=True).encode('utf-8'))
+    for id_ in series.index:
+        digest.update(id_.encode('utf-8') + b'\0')
+    digest.update(np.ascontiguousarray(series.values,
+                                       dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def _path(cache_dir, key):
+    return os.path.join(cache_dir, '%s.npy' % key)
+
+
+def load_cached(cache_dir, key, memory_map=False):
+    """Return the cached distances for ``key``, or None if not cached.
+
+    With ``memory_map`` the cached file is mapped copy-on-write rather than
+    read into memory.
+    """
+    path = _path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='c' if memory_map else None)
+
+
+def store_cached(cache_dir, key, distances):
+    """Write ``distances`` to the cache under ``key``.
+
+    The file is written under a temporary name and then renamed, so
+    concurrent readers never see a partially written entry.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp',
+                                     delete=False) as fh:
+        try:
+            np.save(fh, distances)
+        except BaseException:
+            os.unlink(fh.name)
+            raise
+    os.replace(fh.name, _path(cache_dir, key))
@@ -6,25 +6,1068 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import tempfile
+
 import skbio
 import qiime2
 import numpy as np
-import scipy
+import pandas as pd
+import scipy.linalg
+import scipy.spatial
 
+from ._cache import cache_key, load_cached, store_cached
 
-def distance_matrix(metadata: qiime2.NumericMetadataColumn)\
-        -> skbio.DistanceMatrix:
+
+# Number of rows of the square distance matrix filled per vectorized step
+# when no memory budget is given.
+_BLOCK_ROWS = 1024
+
+# Mean radius of the Earth in kilometers (IUGG).
+_EARTH_RADIUS = 6371.0088
+
+# Length in seconds of the time units supported for temporal distances.
+_TIME_UNITS = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}
+
+# ISO 8601 dates and timestamps accepted for temporal distances: a date
+# with an optional time of day (with optional fractional seconds) and an
+# optional UTC offset.
+_ISO8601_PATTERN = (r'\d{4}-\d{2}-\d{2}'
+                    r'([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?'
+                    r'(Z|[+-]\d{2}(:?\d{2})?)?)?')
+
+# pandas < 2 parses mixed ISO 8601 strings by default, while pandas >= 2
+# infers a single format from the first value unless told otherwise.
+# pandas < 2 also accepts many other formats, so values are matched against
+# _ISO8601_PATTERN first on every version.
+_ISO8601 = {'format': 'ISO8601'} if int(pd.__version__.split('.')[0]) >= 2 \
+    else {}
+
+
+class _Engine:
+    """Base class of the distance engines below.
+
+    Subclasses implement ``__len__`` and ``block(start, stop)``, which
+    returns rows ``start:stop`` of the square distance matrix.
+    ``cell_bytes`` is the peak memory ``block`` uses per cell of the block,
+    including temporaries, and is used to size blocks to a memory budget.
+    """
+
+    cell_bytes = 8
+
+    def dense(self, **kwargs):
+        """Materialize the square distance matrix (see ``_dense``)."""
+        return _dense(self.block, len(self), cell_bytes=self.cell_bytes,
+                      **kwargs)
+
+
+class _SortedColumn(_Engine):
+    """Sort-based distance engine for a one-dimensional numeric column.
+
+    Every pairwise distance on a single axis is ``|x_i - x_j|``, so the
+    sorted values and their sort order are enough to answer nearest-neighbor,
+    radius, and rank queries in O(n log n). The dense n x n matrix is only
+    built when ``dense`` is called.
+    """
+
+    transforms = ('none', 'rank', 'log', 'zscore')
+
+    def __init__(self, values, order=None):
+        self.values = np.asarray(values, dtype=float)
+        if order is None:
+            order = np.argsort(self.values, kind='stable')
+        self.order = order
+        self.sorted_values = self.values[self.order]
+
+    def __len__(self):
+        return len(self.values)
+
+    def transform(self, transform):
+        """Column of the values after a monotonic ``transform``.
+
+        ``transform`` is one of ``'none'``, ``'rank'`` (mean ranks of tied
+        values), ``'log'`` (natural logarithm) or ``'zscore'``. All of them
+        preserve the ordering of the values, so the existing sort order is
+        reused rather than sorting again.
+        """
+        if transform == 'none':
+            return self
+        elif transform == 'rank':
+            values = self.ranks()
+        elif transform == 'log':
+            nonpositive = int((self.values <= 0).sum())
+            if nonpositive:
+                raise ValueError(
+                    "The log transform requires positive values, but %d "
+                    "value(s) are zero or negative." % nonpositive)
+            values = np.log(self.values)
+        elif transform == 'zscore':
+            std = self.values.std()
+            if not std > 0:
+                raise ValueError(
+                    "The zscore transform is undefined when all values are "
+                    "equal.")
+            values = (self.values - self.values.mean()) / std
+        else:
+            raise ValueError(
+                "Unknown transform %r. Supported transforms are: %s"
+                % (transform, ', '.join(self.transforms)))
+        return _SortedColumn(values, order=self.order)
+
+    def block(self, start, stop):
+        """Rows ``start:stop`` of the square distance matrix."""
+        block = np.subtract(self.values[start:stop, np.newaxis],
+                            self.values[np.newaxis, :])
+        return np.abs(block, out=block)
+
+    def ranks(self):
+        """Rank of each value, with tied values receiving their mean rank."""
+        n = len(self)
+        sorted_values = self.sorted_values
+        starts = np.flatnonzero(
+            np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+        stops = np.r_[starts[1:], n]
+        ranks = np.empty(n, dtype=float)
+        ranks[self.order] = np.repeat((starts + stops + 1) / 2,
+                                      stops - starts)
+        return ranks
+
+    def nearest_neighbors(self, k):
+        """Indices and distances of the ``k`` nearest neighbors of each value.
+
+        In one dimension the ``k`` nearest neighbors of a value lie within
+        ``k`` positions of it in sorted order, so only those ``2k``
+        candidates are considered. Both returned arrays have shape
+        ``(n, k)`` and are ordered by increasing distance.
+        """
+        n = len(self)
+        if not 1 <= k < n:
+            raise ValueError(
+                "The number of neighbors must be at least 1 and less than "
+                "the number of values (%d), but %d was provided." % (n, k))
+
+        offsets = np.arange(1, k + 1)
+        # Interleave offsets as -1, +1, -2, +2, ... so that ties in distance
+        # are broken in favor of the neighbor closer in sorted order.
+        offsets = np.column_stack((-offsets, offsets)).ravel()
+        positions = np.arange(n)[:, np.newaxis] + offsets[np.newaxis, :]
+        out_of_range = (positions < 0) | (positions >= n)
+        positions = np.clip(positions, 0, n - 1)
+
+        distances = np.abs(self.sorted_values[positions] -
+                           self.sorted_values[:, np.newaxis])
+        distances[out_of_range] = np.inf
+        nearest = np.argsort(distances, axis=1, kind='stable')[:, :k]
+
+        positions = np.take_along_axis(positions, nearest, axis=1)
+        distances = np.take_along_axis(distances, nearest, axis=1)
+        # Rows are in sorted order; scatter them back to the input order.
+        indices = np.empty_like(positions)
+        indices[self.order] = self.order[positions]
+        result = np.empty_like(distances)
+        result[self.order] = distances
+        return indices, result
+
+    def within(self, radius):
+        """All pairs of values whose distance is at most ``radius``.
+
+        Pairs are found with a single sweep over the sorted values and are
+        returned as three arrays ``(i, j, distance)`` with ``i != j``, each
+        unordered pair reported once.
+        """
+        if radius < 0:
+            raise ValueError(
+                "The radius must be non-negative, but %r was provided."
+                % radius)
+
+        n = len(self)
+        sorted_values = self.sorted_values
+        stops = np.searchsorted(sorted_values, sorted_values + radius,
+                                side='right')
+        counts = stops - np.arange(n) - 1
+        left = np.repeat(np.arange(n), counts)
+        right = left + 1 + (np.arange(counts.sum()) -
+                            np.repeat(np.cumsum(counts) - counts, counts))
+        distances = sorted_values[right] - sorted_values[left]
+
+        keep = distances <= radius
+        return (self.order[left[keep]], self.order[right[keep]],
+                distances[keep])
+
+
+class _QuantizedColumn(_Engine):
+    """Distance engine for a numeric column with a coarse, regular resolution.
+
+    Values that are all multiples of ``resolution`` apart (e.g., ages in
+    whole years) are stored as small unsigned integer codes, and so are the
+    distances between them: a column with at most 256 distinct levels needs
+    one byte per distance and one with at most 65536 levels needs two,
+    instead of eight for float64. Codes are multiplied by ``resolution``
+    only when distances are expanded.
+    """
+
+    def __init__(self, values, resolution):
+        if not resolution > 0:
+            raise ValueError(
+                "The resolution must be positive, but %r was provided."
+                % resolution)
+
+        values = np.asarray(values, dtype=float)
+        steps = (values - values.min()) / resolution
+        codes = np.rint(steps)
+        off_grid = int((np.abs(codes - steps) > 1e-6).sum())
+        if off_grid:
+            raise ValueError(
+                "%d value(s) in the metadata column are not a whole number "
+                "of resolution steps (%r) apart from the smallest value."
+                % (off_grid, resolution))
+
+        for dtype in np.uint8, np.uint16:
+            if codes.max() <= np.iinfo(dtype).max:
+                break
+        else:
+            raise ValueError(
+                "The values span more than %d resolution steps, which is too "
+                "many to quantize. Use a coarser resolution."
+                % np.iinfo(np.uint16).max)
+
+        self.codes = codes.astype(dtype)
+        self.resolution = resolution
+
+    # An int32 difference block and its narrowed codes, or the codes and
+    # the float64 distances expanded from them.
+    cell_bytes = 10
+
+    def __len__(self):
+        return len(self.codes)
+
+    def code_block(self, start, stop):
+        """Rows ``start:stop`` of the square matrix of distance codes."""
+        block = np.subtract(self.codes[start:stop, np.newaxis],
+                            self.codes[np.newaxis, :], dtype=np.int32)
+        return np.abs(block, out=block).astype(self.codes.dtype)
+
+    def block(self, start, stop):
+        """Rows ``start:stop`` of the square distance matrix."""
+        return self.code_block(start, stop) * self.resolution
+
+    def dense_codes(self, **kwargs):
+        """Materialize the square matrix of distance codes."""
+        return _dense(self.code_block, len(self), dtype=self.codes.dtype,
+                      cell_bytes=self.cell_bytes, **kwargs)
+
+    def expand(self, codes, **kwargs):
+        """Expand a square matrix of distance codes to distances."""
+        def block(start, stop):
+            return codes[start:stop] * self.resolution
+        return _dense(block, len(codes), cell_bytes=self.cell_bytes,
+                      **kwargs)
+
+
+class _GroupedColumn(_Engine):
+    """Mismatch distance engine for a categorical column.
+
+    Only one integer group code per value is stored. Two values are at
+    distance 0 if they belong to the same group and 1 otherwise, so a column
+    with g groups has just g^2 distinct blocks, and the dense matrix is only
+    expanded from the codes when ``dense`` is called.
+    """
+
+    def __init__(self, values):
+        self.codes, self.groups = pd.factorize(np.asarray(values))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def block(self, start, stop):
+        """Rows ``start:stop`` of the square distance matrix."""
+        return self.codes[start:stop, np.newaxis] != \
+            self.codes[np.newaxis, :]
+
+    def members(self):
+        """Positions of the values in each group, in order of appearance."""
+        order = np.argsort(self.codes, kind='stable')
+        sizes = np.bincount(self.codes, minlength=len(self.groups))
+        return dict(zip(self.groups, np.split(order, np.cumsum(sizes)[:-1])))
+
+
+class _NumericTable(_Engine):
+    """Distance engine for several numeric columns.
+
+    The columns are standardized, weighted or whitened once up front, and
+    row blocks of the square distance matrix are then computed with a
+    single vectorized ``cdist`` call over all columns.
+    """
+
+    # Maps the metric names exposed by the plugin to the scipy metric used
+    # on the preprocessed values. Mahalanobis distances are Euclidean
+    # distances between values whitened with the covariance matrix.
+    metrics = {'euclidean': 'euclidean', 'manhattan': 'cityblock',
+               'chebyshev': 'chebyshev', 'cosine': 'cosine',
+               'mahalanobis': 'euclidean'}
+
+    # Power to which each weight is raised when it is folded into the
+    # column values, so that e.g. weighted Euclidean distances are
+    # sqrt(sum(w * (x - y) ** 2)).
+    _weight_powers = {'euclidean': 0.5, 'manhattan': 1.0, 'chebyshev': 1.0,
+                      'cosine': 0.5}
+
+    def __init__(self, values, metric='euclidean', standardize=False,
+                 weights=None):
+        if metric not in self.metrics:
+            raise ValueError(
+                "Unknown metric %r. Supported metrics are: %s"
+                % (metric, ', '.join(self.metrics)))
+
+        values = np.asarray(values, dtype=float)
+        self.missing = np.isnan(values)
+        self.pairwise = bool(self.missing.any())
+        if self.pairwise and metric == 'mahalanobis':
+            raise ValueError(
+                "The Mahalanobis distance cannot be computed from values "
+                "with missing data.")
+
+        if standardize:
+            # Constant columns carry no information, so they are left at 0
+            # rather than divided by a standard deviation of 0.
+            std = np.nanstd(values, axis=0)
+            std[std == 0] = 1.0
+            values = (values - np.nanmean(values, axis=0)) / std
+
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            if weights.shape != (values.shape[1],):
+                raise ValueError(
+                    "%d weights were provided for %d columns. Exactly one "
+                    "weight per column is required."
+                    % (weights.size, values.shape[1]))
+            if (weights < 0).any() or not weights.any():
+                raise ValueError(
+                    "Weights must be non-negative and at least one must be "
+                    "positive.")
+            if metric == 'mahalanobis':
+                raise ValueError(
+                    "Weights cannot be used with the Mahalanobis distance, "
+                    "which is unaffected by rescaling the columns.")
+            values = values * weights ** self._weight_powers[metric]
+        else:
+            weights = np.ones(values.shape[1])
+
+        if metric == 'mahalanobis':
+            values = self._whiten(values)
+
+        self.values = values
+        self.weights = weights
+        self.metric = metric
+        if self.pairwise:
+            self._present = ~self.missing
+            self._filled = np.where(self._present, values, 0.0)
+
+    @property
+    def cell_bytes(self):
+        if not self.pairwise:
+            return 8
+        # The shared weights, the running totals and a scratch array (and
+        # the two norms for cosine), plus a boolean mask.
+        return 8 * (5 if self.metric == 'cosine' else 3) + 1
+
+    @staticmethod
+    def _whiten(values):
+        """Transform values so that their covariance is the identity."""
+        covariance = np.atleast_2d(np.cov(values, rowvar=False))
+        try:
+            cholesky = np.linalg.cholesky(covariance)
+        except np.linalg.LinAlgError:
+            raise ValueError(
+                "The Mahalanobis distance requires a non-singular covariance "
+                "matrix. Check that there are more samples or features than "
+                "columns and that no column is constant or a linear "
+                "combination of the others.")
+        centered = values - values.mean(axis=0)
+        return scipy.linalg.solve_triangular(cholesky, centered.T,
+                                             lower=True).T
+
+    def zero_rows(self):
+        """Mask of rows whose (preprocessed) values are all zero or missing.
+        """
+        return ~np.nan_to_num(self.values).any(axis=1)
+
+    def __len__(self):
+        return len(self.values)
+
+    def block(self, start, stop):
+        """Rows ``start:stop`` of the square distance matrix."""
+        if self.pairwise:
+            block = self._pairwise_block(start, stop)
+        else:
+            block = scipy.spatial.distance.cdist(
+                self.values[start:stop], self.values,
+                metric=self.metrics[self.metric])
+        # Round-off can leave tiny non-zero self-distances (e.g. cosine).
+        rows = np.arange(stop - start)
+        block[rows, rows + start] = 0.0
+        return block
+
+    def _pairwise_block(self, start, stop):
+        """Like ``block``, using only the columns present in both values.
+
+        Each pair is compared over the columns in which neither value is
+        missing. Euclidean and Manhattan distances are scaled up by the
+        ratio of the total weight of all columns to that of the shared
+        columns, so that pairs with fewer shared columns are not made
+        artificially close.
+        """
+        rows = slice(start, stop)
+        present, values = self._present, self._filled
+
+        shape = (stop - start, len(self))
+        shared = np.zeros(shape)
+        total = np.zeros(shape)
+        scratch = np.empty(shape)
+        both = np.empty(shape, dtype=bool)
+        if self.metric == 'cosine':
+            norms_x = np.zeros(shape)
+            norms_y = np.zeros(shape)
+
+        for k, weight in enumerate(self.weights):
+            np.logical_and(present[rows, k, np.newaxis],
+                           present[np.newaxis, :, k], out=both)
+            x = values[rows, k, np.newaxis]
+            y = values[np.newaxis, :, k]
+            np.add(shared, weight, out=shared, where=both)
+            if self.metric == 'cosine':
+                np.multiply(x, y, out=scratch)
+                np.add(total, scratch, out=total, where=both)
+                np.add(norms_x, x * x, out=norms_x, where=both)
+                np.add(norms_y, y * y, out=norms_y, where=both)
+                continue
+
+            np.subtract(x, y, out=scratch)
+            np.abs(scratch, out=scratch)
+            if self.metric == 'euclidean':
+                np.square(scratch, out=scratch)
+            if self.metric == 'chebyshev':
+                np.maximum(total, scratch, out=total, where=both)
+            else:
+                np.add(total, scratch, out=total, where=both)
+
+        if not shared.all():
+            raise ValueError(
+                "At least one pair of IDs has no (positively weighted) column "
+                "in which both have values, so the distance between them is "
+                "undefined.")
+
+        if self.metric in ('euclidean', 'manhattan'):
+            np.divide(self.weights.sum(), shared, out=shared)
+            total *= shared
+            if self.metric == 'euclidean':
+                np.sqrt(total, out=total)
+            return total
+        elif self.metric == 'chebyshev':
+            return total
+
+        norms_x *= norms_y
+        np.sqrt(norms_x, out=norms_x)
+        if not norms_x.all():
+            raise ValueError(
+                "The cosine distance is undefined for at least one pair of "
+                "IDs whose values in their shared columns are all zero.")
+        total /= norms_x
+        return np.subtract(1.0, total, out=total)
+
+
+class _GowerTable(_Engine):
+    """Gower distance engine for mixed numeric and categorical columns.
+
+    Numeric columns are divided by their range so that each contributes a
+    distance in [0, 1], and categorical columns are reduced to integer codes
+    that contribute 0 when equal and 1 otherwise. The Gower distance is the
+    mean contribution over all columns.
+    """
+
+    def __init__(self, numeric, categorical):
+        numeric = np.asarray(numeric, dtype=float)
+        categorical = np.asarray(categorical)
+        ranges = np.nanmax(numeric, axis=0, initial=-np.inf) - \
+            np.nanmin(numeric, axis=0, initial=np.inf)
+        # Constant columns never contribute, so avoid dividing by zero.
+        ranges[~(ranges > 0)] = 1.0
+        self.numeric = numeric / ranges
+        # Missing categorical values are given the code -1.
+        self.codes = np.empty(categorical.shape, dtype=np.intp)
+        for i, column in enumerate(categorical.T):
+            self.codes[:, i] = pd.factorize(column)[0]
+        self.n_columns = self.numeric.shape[1] + self.codes.shape[1]
+        self.pairwise = bool(np.isnan(self.numeric).any() or
+                             (self.codes < 0).any())
+
+    @property
+    def cell_bytes(self):
+        if self.pairwise:
+            # The shared counts, the totals, a scratch array and a mask.
+            return 8 * 3 + 1
+        # The numeric and categorical contributions.
+        return 16 if self.numeric.shape[1] and self.codes.shape[1] else 8
+
+    def __len__(self):
+        return len(self.numeric)
+
+    def block(self, start, stop):
+        """Rows ``start:stop`` of the square distance matrix."""
+        if self.pairwise:
+            return self._pairwise_block(start, stop)
+
+        if self.numeric.shape[1]:
+            block = scipy.spatial.distance.cdist(
+                self.numeric[start:stop], self.numeric, metric='cityblock')
+        else:
+            block = np.zeros((stop - start, len(self)))
+        if self.codes.shape[1]:
+            # Hamming distances are the fraction of mismatched columns.
+            mismatches = scipy.spatial.distance.cdist(
+                self.codes[start:stop], self.codes, metric='hamming')
+            mismatches *= self.codes.shape[1]
+            block += mismatches
+        block /= self.n_columns
+        return block
+
+    def _pairwise_block(self, start, stop):
+        """Like ``block``, averaging only over columns present in both values.
+        """
+        rows = slice(start, stop)
+        shape = (stop - start, len(self))
+        shared = np.zeros(shape)
+        total = np.zeros(shape)
+        scratch = np.empty(shape)
+        both = np.empty(shape, dtype=bool)
+
+        for column in self.numeric.T:
+            x = column[rows, np.newaxis]
+            y = column[np.newaxis, :]
+            np.logical_and(~np.isnan(x), ~np.isnan(y), out=both)
+            np.subtract(x, y, out=scratch)
+            np.abs(scratch, out=scratch)
+            np.add(shared, 1.0, out=shared, where=both)
+            np.add(total, scratch, out=total, where=both)
+        for column in self.codes.T:
+            x = column[rows, np.newaxis]
+            y = column[np.newaxis, :]
+            np.logical_and(x >= 0, y >= 0, out=both)
+            np.not_equal(x, y, out=scratch)
+            np.add(shared, 1.0, out=shared, where=both)
+            np.add(total, scratch, out=total, where=both)
+
+        if not shared.all():
+            raise ValueError(
+                "At least one pair of IDs has no column in which both have "
+                "values, so the Gower distance between them is undefined.")
+        total /= shared
+        return total
+
+
+class _GeographicTable(_Engine):
+    """Great-circle distance engine for latitude/longitude coordinates.
+
+    Coordinates are converted to radians once, and row blocks of the square
+    distance matrix are computed with the vectorized haversine formula.
+    Distances are in kilometers.
+    """
+
+    # The cosine products and the haversines of the longitude and latitude
+    # differences are held in two block-sized arrays.
+    cell_bytes = 16
+
+    def __init__(self, latitude, longitude):
+        self.latitude = np.radians(np.asarray(latitude, dtype=float))
+        self.longitude = np.radians(np.asarray(longitude, dtype=float))
+        self.cos_latitude = np.cos(self.latitude)
+
+    def __len__(self):
+        return len(self.latitude)
+
+    @staticmethod
+    def _haversine(angles):
+        """Replace ``angles`` with their haversines, sin(|angle| / 2) ** 2.
+        """
+        np.abs(angles, out=angles)
+        angles *= 0.5
+        np.sin(angles, out=angles)
+        return np.square(angles, out=angles)
+
+    def block(self, start, stop):
+        """Rows ``start:stop`` of the square distance matrix.
+
+        Every step is symmetric in the two points (absolute differences and
+        a single product of their cosines), so the matrix is exactly
+        symmetric.
+        """
+        rows = slice(start, stop)
+        lon = np.multiply.outer(self.cos_latitude[rows], self.cos_latitude)
+        lon *= self._haversine(np.subtract.outer(self.longitude[rows],
+                                                 self.longitude))
+        lat = self._haversine(np.subtract.outer(self.latitude[rows],
+                                                self.latitude))
+        lat += lon
+        # Round-off can push antipodal points slightly past 1.
+        np.clip(lat, 0.0, 1.0, out=lat)
+        np.sqrt(lat, out=lat)
+        np.arcsin(lat, out=lat)
+        lat *= 2 * _EARTH_RADIUS
+        return lat
+
+
+def _block_rows(n, max_memory=None, cell_bytes=8):
+    """Rows per block so that an n-column block fits ``max_memory``.
+
+    ``max_memory`` is given in megabytes and ``cell_bytes`` is the memory
+    used per cell of the block (8 for a single float64 block). At least one
+    row is always computed per block.
+    """
+    if max_memory is None:
+        return _BLOCK_ROWS
+    if max_memory < 1:
+        raise ValueError(
+            "The memory budget must be at least 1 MB, but %r was provided."
+            % max_memory)
+    row_bytes = max(n, 1) * cell_bytes
+    return max(1, int(max_memory * 2 ** 20) // row_bytes)
+
+
+def _dense(block, n, dtype='float64', memory_map=False, max_memory=None,
+           cell_bytes=8):
+    """Fill an n x n matrix from row blocks produced by ``block``.
+
+    ``block(start, stop)`` must return rows ``start:stop`` of the matrix,
+    using ``cell_bytes`` bytes per cell. Blocks are sized to fit
+    ``max_memory`` megabytes and are cast to ``dtype`` as they are written.
+    If ``memory_map`` is true the matrix is backed by a memory-mapped
+    temporary file instead of being held in memory.
+    """
+    result = _empty((n, n), dtype, memory_map)
+    _fill(result, block, max_memory=max_memory, cell_bytes=cell_bytes)
+    return result
+
+
+def _empty(shape, dtype, memory_map):
+    if memory_map:
+        return _memory_mapped_array(shape, dtype)
+    return np.empty(shape, dtype=dtype)
+
+
+def _fill(result, block, start=0, max_memory=None, cell_bytes=8):
+    """Fill rows ``start:`` of ``result`` from row blocks of ``block``."""
+    n_rows, n = result.shape
+    block_rows = _block_rows(n, max_memory, cell_bytes)
+    for row in range(start, n_rows, block_rows):
+        stop = min(row + block_rows, n_rows)
+        result[row:stop] = block(row, stop)
+
+
+def _memory_mapped_array(shape, dtype):
+    # The temporary file is unlinked as soon as it is closed, but the mapping
+    # keeps its storage alive for as long as the array is referenced.
+    with tempfile.TemporaryFile(prefix='q2-metadata-') as fh:
+        return np.memmap(fh, dtype=dtype, mode='w+', shape=shape)
+
+
+def _trusted_distance_matrix(distances, ids):
+    """Wrap distances computed by this module in a DistanceMatrix.
+
+    Every engine computes each distance with operations that are symmetric
+    in the two values, so its matrices are exactly (not just approximately)
+    symmetric and hollow. The IDs come from already-validated Metadata, so
+    skbio's O(n^2) symmetry, hollowness and ID checks are skipped. Engines
+    must keep this property, which the tests check for each of them.
+    """
+    return skbio.DistanceMatrix(distances, ids=ids, validate=False)
+
+
+def _check_missing(metadata, name=None):
     if metadata.has_missing_values():
         missing = metadata.get_ids(where_values_missing=True)
+        column = 'metadata column' if name is None else \
+            'metadata column %r' % name
+        raise ValueError(
+            "Encountered missing value(s) in the %s. Computing a distance "
+            "matrix from missing values is not supported. IDs with missing "
+            "values: %s" % (column, ', '.join(sorted(missing))))
+
+
+def _handle_missing(df, missing, where, alternatives=('drop', 'pairwise')):
+    """Apply a ``missing`` policy of 'error', 'drop' or 'pairwise' to ``df``.
+
+    With 'pairwise', rows with missing values are kept and the engine
+    compares each pair over the columns in which both have values.
+    ``alternatives`` are the other policies the calling action offers,
+    which are suggested in the error raised by 'error'.
+    """
+    rows = df.isna().any(axis=1)
+    if missing == 'error' and rows.any():
+        unless = ''
+        if alternatives:
+            unless = ' unless `missing` is %s' % ' or '.join(
+                "'%s'" % alternative for alternative in alternatives)
+        raise ValueError(
+            "Encountered missing value(s) in %s. Computing a distance matrix "
+            "from missing values is not supported%s. IDs with missing "
+            "values: %s" % (where, unless, ', '.join(sorted(df.index[rows]))))
+    elif missing == 'drop':
+        df = df[~rows]
+        if df.empty:
+            raise ValueError(
+                "Every ID has missing value(s) in %s, so no IDs remain after "
+                "dropping them." % where)
+    return df
+
+
+def _align(metadata, ids):
+    """Restrict ``metadata`` to ``ids``, which must all be present in it."""
+    unknown = pd.Index(ids).difference(pd.Index(metadata.get_ids()))
+    if len(unknown) > 0:
         raise ValueError(
-            "Encountered missing value(s) in the metadata column. Computing "
-            "a distance matrix from missing values is not supported. IDs with "
-            "missing values: %s" % ', '.join(sorted(missing)))
+            "The metadata column must contain every ID in the distance "
+            "matrix. IDs missing from the metadata column: %s"
+            % ', '.join(sorted(unknown)))
+    return metadata.filter_ids(ids)
+
+
+def distance_matrix(metadata: qiime2.NumericMetadataColumn,
+                    reference: skbio.DistanceMatrix = None,
+                    precision: str = 'float64',
+                    memory_map: bool = False,
+                    max_memory: int = None,
+                    cache_dir: str = None,
+                    transform: str = 'none',
+                    resolution: float = None,
+                    missing: str = 'error') -> skbio.DistanceMatrix:
+    if resolution is not None and cache_dir is None:
+        raise ValueError(
+            "A resolution only reduces the size of cached distance matrices, "
+            "so it requires a cache directory.")
+    if reference is not None:
+        # Only the reference's IDs are checked and computed, in its order.
+        metadata = _align(metadata, reference.ids)
+    if missing == 'error':
+        _check_missing(metadata)
+    series = _handle_missing(metadata.to_series().to_frame(), missing,
+                             'the metadata column').iloc[:, 0]
+    if reference is not None:
+        # IDs dropped for missing values are omitted from the reference order.
+        series = series.reindex(
+            [i for i in reference.ids if i in series.index])
+
+    if cache_dir is not None:
+        # Only settings that change the cached array belong in the key.
+        # Quantized entries hold integer codes that are expanded to either
+        # precision, so they are shared between precisions.
+        settings = {'transform': transform, 'resolution': resolution}
+        if resolution is None:
+            settings['precision'] = precision
+        key = cache_key(series, **settings)
+        cached = load_cached(cache_dir, key, memory_map=memory_map)
+        if cached is not None and resolution is None:
+            return _trusted_distance_matrix(cached, series.index)
+
+    if resolution is None:
+        result = _column_distance_matrix(series, transform=transform,
+                                         dtype=precision,
+                                         memory_map=memory_map,
+                                         max_memory=max_memory)
+        if cache_dir is not None:
+            store_cached(cache_dir, key, result.data)
+        return result
+
+    # Cache entries hold the compact integer codes, which are expanded to
+    # distances block by block.
+    column = _SortedColumn(series.values).transform(transform)
+    column = _QuantizedColumn(column.values, resolution)
+    if cached is None:
+        cached = column.dense_codes(memory_map=memory_map,
+                                    max_memory=max_memory)
+        store_cached(cache_dir, key, cached)
+    distances = column.expand(cached, dtype=precision, memory_map=memory_map,
+                              max_memory=max_memory)
+    return _trusted_distance_matrix(distances, series.index)
 
-    # This code is derived from @jairideout's scikit-bio cookbook recipe,
-    # "Exploring Microbial Community Diversity"
-    # https://github.com/biocore/scikit-bio-cookbook
+
+def _column_distance_matrix(series, transform='none', **kwargs):
+    # The Euclidean distance between two values on a single axis is their
+    # absolute difference, so the matrix is built directly from the sorted
+    # column rather than from scipy's condensed ``pdist`` output.
+    column = _SortedColumn(series.values).transform(transform)
+    return _trusted_distance_matrix(column.dense(**kwargs), series.index)
+
+
+def grouped_distance_matrices(metadata: qiime2.NumericMetadataColumn,
+                              group_by: qiime2.CategoricalMetadataColumn,
+                              precision: str = 'float64',
+                              memory_map: bool = False,
+                              max_memory: int = None) -> skbio.DistanceMatrix:
+    _check_missing(metadata)
     series = metadata.to_series()
-    distances = scipy.spatial.distance.pdist(
-        series.values[:, np.newaxis], metric='euclidean')
-    return skbio.DistanceMatrix(distances, ids=series.index)
+
+    groups = group_by.to_series()
+    ungrouped = series.index.difference(groups.index)
+    if len(ungrouped) > 0:
+        raise ValueError(
+            "The group_by column must contain every ID in the metadata "
+            "column. IDs without a group: %s" % ', '.join(sorted(ungrouped)))
+    groups = groups.reindex(series.index)
+    if groups.isna().any():
+        raise ValueError(
+            "Encountered missing value(s) in the group_by column. IDs with "
+            "missing groups: %s"
+            % ', '.join(sorted(groups.index[groups.isna()])))
+
+    # Only the pairs within each group are computed, so the work is the sum
+    # of the squared group sizes rather than the square of the column size.
+    result = {}
+    for group, members in _GroupedColumn(groups.values).members().items():
+        result[str(group)] = _column_distance_matrix(
+            series.iloc[members], dtype=precision, memory_map=memory_map,
+            max_memory=max_memory)
+    return result
+
+
+def _parse_timestamps(series, unit):
+    """Convert ISO 8601 strings to offsets from the earliest one in ``unit``.
+
+    All values are parsed in one vectorized call. Timestamps with a time
+    zone are converted to UTC, and those without are taken to be in UTC.
+    """
+    if unit not in _TIME_UNITS:
+        raise ValueError(
+            "Unknown time unit %r. Supported units are: %s"
+            % (unit, ', '.join(_TIME_UNITS)))
+
+    iso8601 = series.astype(str).str.fullmatch(_ISO8601_PATTERN)
+    timestamps = pd.to_datetime(series.where(iso8601), utc=True,
+                                errors='coerce', **_ISO8601)
+    invalid = series.index[timestamps.isna()]
+    if len(invalid) > 0:
+        raise ValueError(
+            "Encountered value(s) in the metadata column that are not ISO "
+            "8601 dates or timestamps (e.g., 2021-03-14 or "
+            "2021-03-14T15:09:26). IDs with invalid values: %s"
+            % ', '.join(sorted(invalid)))
+
+    seconds = (timestamps - timestamps.min()).dt.total_seconds()
+    return seconds.values / _TIME_UNITS[unit]
+
+
+def temporal_distance_matrix(metadata: qiime2.CategoricalMetadataColumn,
+                             unit: str = 'days',
+                             precision: str = 'float64',
+                             memory_map: bool = False,
+                             max_memory: int = None) -> skbio.DistanceMatrix:
+    _check_missing(metadata)
+
+    series = metadata.to_series()
+    times = pd.Series(_parse_timestamps(series, unit), index=series.index)
+    return _column_distance_matrix(times, dtype=precision,
+                                   memory_map=memory_map,
+                                   max_memory=max_memory)
+
+
+def categorical_distance_matrix(metadata: qiime2.CategoricalMetadataColumn,
+                                precision: str = 'float64',
+                                memory_map: bool = False,
+                                max_memory: int = None) \
+        -> skbio.DistanceMatrix:
+    _check_missing(metadata)
+
+    series = metadata.to_series()
+    column = _GroupedColumn(series.values)
+    distances = column.dense(dtype=precision, memory_map=memory_map,
+                             max_memory=max_memory)
+    return _trusted_distance_matrix(distances, series.index)
+
+
+def update_distance_matrix(distance_matrix: skbio.DistanceMatrix,
+                           metadata: qiime2.NumericMetadataColumn,
+                           precision: str = 'float64',
+                           memory_map: bool = False,
+                           max_memory: int = None,
+                           transform: str = 'none') -> skbio.DistanceMatrix:
+    if transform in ('rank', 'zscore'):
+        raise ValueError(
+            "Distance matrices computed with the %r transform cannot be "
+            "updated, because the transformed values depend on every value "
+            "in the column. Compute a new distance matrix instead."
+            % transform)
+    _check_missing(metadata)
+    series = metadata.to_series()
+
+    old_ids = pd.Index(distance_matrix.ids)
+    _align(metadata, old_ids)
+
+    # Existing IDs keep their positions and new IDs are appended in the
+    # order they appear in the metadata.
+    ids = old_ids.append(series.index[~series.index.isin(old_ids)])
+    # The new distances are computed with the same settings as the existing
+    # ones, which is only possible for transforms of individual values.
+    column = _SortedColumn(series.reindex(ids).values).transform(transform)
+    n_old, n = len(old_ids), len(ids)
+
+    distances = _empty((n, n), precision, memory_map)
+    distances[:n_old, :n_old] = distance_matrix.data
+    _fill(distances, column.block, start=n_old, max_memory=max_memory,
+          cell_bytes=column.cell_bytes)
+    distances[:n_old, n_old:] = distances[n_old:, :n_old].T
+    return _trusted_distance_matrix(distances, ids)
+
+
+def sparse_distance_matrix(metadata: qiime2.NumericMetadataColumn,
+                           n_neighbors: int = None,
+                           max_distance: float = None) -> pd.DataFrame:
+    if (n_neighbors is None) == (max_distance is None):
+        raise ValueError(
+            "Exactly one of n_neighbors or max_distance must be provided.")
+    _check_missing(metadata)
+
+    series = metadata.to_series()
+    column = _SortedColumn(series.values)
+    if n_neighbors is not None:
+        neighbors, distances = column.nearest_neighbors(n_neighbors)
+        first = np.repeat(np.arange(len(column)), n_neighbors)
+        second = neighbors.ravel()
+        distances = distances.ravel()
+    else:
+        first, second, distances = column.within(max_distance)
+        # Report each pair once, in the order of the IDs in the metadata.
+        first, second = (np.minimum(first, second),
+                         np.maximum(first, second))
+        order = np.lexsort((second, first))
+        first, second, distances = \
+            first[order], second[order], distances[order]
+
+    ids = series.index.values
+    return pd.DataFrame({'id1': ids[first], 'id2': ids[second],
+                         'distance': distances})
+
+
+def distance_matrices(metadata: qiime2.Metadata,
+                      columns: str = None,
+                      precision: str = 'float64',
+                      memory_map: bool = False,
+                      max_memory: int = None,
+                      transform: str = 'none') -> skbio.DistanceMatrix:
+    numeric = metadata.filter_columns(column_type='numeric')
+    if columns is None:
+        columns = list(numeric.columns)
+        if not columns:
+            raise ValueError(
+                "The metadata does not contain any numeric columns. At least "
+                "one numeric column is required to compute a distance "
+                "matrix.")
+    else:
+        columns = list(columns)
+        if not columns:
+            raise ValueError(
+                "At least one column must be provided to compute distance "
+                "matrices.")
+        duplicates = sorted({c for c in columns if columns.count(c) > 1})
+        if duplicates:
+            raise ValueError(
+                "Each column can only be provided once. Duplicated columns: "
+                "%s" % ', '.join(map(repr, duplicates)))
+        for column in columns:
+            if column not in metadata.columns:
+                raise ValueError(
+                    "Column %r is not present in the metadata." % column)
+            if column not in numeric.columns:
+                raise ValueError(
+                    "Column %r is not numeric. Distance matrices can only be "
+                    "computed from numeric columns." % column)
+
+    # IDs, missing values and the conversion to pandas are handled once for
+    # all columns rather than once per distance matrix.
+    df = _handle_missing(numeric.to_dataframe()[list(columns)], 'error',
+                         'the metadata columns', alternatives=())
+
+    return {column: _column_distance_matrix(df[column], transform=transform,
+                                            dtype=precision,
+                                            memory_map=memory_map,
+                                            max_memory=max_memory)
+            for column in columns}
+
+
+def metadata_distance_matrix(metadata: qiime2.Metadata,
+                             metric: str = 'euclidean',
+                             standardize: bool = False,
+                             weights: float = None,
+                             missing: str = 'error',
+                             precision: str = 'float64',
+                             memory_map: bool = False,
+                             max_memory: int = None) -> skbio.DistanceMatrix:
+    metadata = metadata.filter_columns(column_type='numeric')
+    if metadata.column_count == 0:
+        raise ValueError(
+            "The metadata does not contain any numeric columns. At least one "
+            "numeric column is required to compute a distance matrix.")
+
+    df = _handle_missing(metadata.to_dataframe(), missing,
+                         'the numeric metadata columns')
+    table = _NumericTable(df.values, metric=metric, standardize=standardize,
+                          weights=weights)
+    if metric == 'cosine':
+        zero = df.index[table.zero_rows()]
+        if len(zero) > 0:
+            raise ValueError(
+                "The cosine distance is undefined for IDs whose values are "
+                "all zero. IDs with all-zero values: %s"
+                % ', '.join(sorted(zero)))
+
+    distances = table.dense(dtype=precision, memory_map=memory_map,
+                            max_memory=max_memory)
+    return _trusted_distance_matrix(distances, df.index)
+
+
+def gower_distance_matrix(metadata: qiime2.Metadata,
+                          missing: str = 'error',
+                          precision: str = 'float64',
+                          memory_map: bool = False,
+                          max_memory: int = None) -> skbio.DistanceMatrix:
+    if metadata.column_count == 0:
+        raise ValueError(
+            "The metadata does not contain any columns. At least one column "
+            "is required to compute a distance matrix.")
+
+    df = _handle_missing(metadata.to_dataframe(), missing, 'the metadata')
+    numeric = metadata.filter_columns(column_type='numeric').to_dataframe()
+    categorical = \
+        metadata.filter_columns(column_type='categorical').to_dataframe()
+    numeric, categorical = numeric.loc[df.index], categorical.loc[df.index]
+
+    table = _GowerTable(numeric.values, categorical.values)
+    distances = table.dense(dtype=precision, memory_map=memory_map,
+                            max_memory=max_memory)
+    return _trusted_distance_matrix(distances, df.index)
+
+
+def haversine_distance_matrix(latitude: qiime2.NumericMetadataColumn,
+                              longitude: qiime2.NumericMetadataColumn,
+                              precision: str = 'float64',
+                              memory_map: bool = False,
+                              max_memory: int = None) -> skbio.DistanceMatrix:
+    for column in latitude, longitude:
+        _check_missing(column, column.name)
+
+    latitude = latitude.to_series()
+    longitude = longitude.to_series()
+    if set(latitude.index) != set(longitude.index):
+        mismatched = set(latitude.index) ^ set(longitude.index)
+        raise ValueError(
+            "The latitude and longitude columns must contain the same IDs. "
+            "IDs present in only one column: %s"
+            % ', '.join(sorted(mismatched)))
+    longitude = longitude.reindex(latitude.index)
+
+    if ((latitude < -90) | (latitude > 90)).any():
+        raise ValueError("Latitudes must be between -90 and 90 degrees.")
+    if ((longitude < -180) | (longitude > 180)).any():
+        raise ValueError("Longitudes must be between -180 and 180 degrees.")
+
+    table = _GeographicTable(latitude.values, longitude.values)
+    distances = table.dense(dtype=precision, memory_map=memory_map,
+                            max_memory=max_memory)
+    return _trusted_distance_matrix(distances, latitude.index)
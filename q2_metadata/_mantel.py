@@ -0,0 +1,140 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import pkg_resources
+
+import numpy as np
+import pandas as pd
+import skbio
+
+import qiime2
+import q2templates
+
+from ._distance import _SortedColumn, _align, _block_rows, _check_missing
+
+
+TEMPLATES = pkg_resources.resource_filename('q2_metadata', 'templates')
+
+
+def _pair_sums(column, distances, max_memory=None, cross_only=False):
+    """Sums of x, x^2 and x * y over all pairs, streamed in row blocks.
+
+    ``x`` are the distances between the values of ``column`` and ``y`` are
+    ``distances``. Both matrices are symmetric and hollow, so the sums over
+    full rows are twice the sums over the pairs. With ``cross_only`` only
+    the sum of x * y is computed and returned.
+    """
+    n = len(column)
+    sum_x = sum_xx = sum_xy = 0.0
+    block_rows = _block_rows(n, max_memory)
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        x = column.block(start, stop)
+        sum_xy += np.einsum('ij,ij->', x, distances[start:stop])
+        if not cross_only:
+            sum_x += x.sum()
+            sum_xx += np.einsum('ij,ij->', x, x)
+    if cross_only:
+        return sum_xy / 2
+    return sum_x / 2, sum_xx / 2, sum_xy / 2
+
+
+def _mantel(distances, values, permutations=999, alternative='two-sided',
+            max_memory=None, random_seed=None):
+    """Pearson Mantel test between a distance matrix and a numeric column.
+
+    The metadata distances are regenerated block by block for the observed
+    ordering and for each permutation, so only one n x n matrix (the input
+    ``distances``) is ever held in memory. Permuting the rows and columns of
+    the metadata distance matrix is equivalent to permuting ``values``.
+    Permutations are drawn from a Generator seeded with ``random_seed``.
+    """
+    n = len(values)
+    n_pairs = n * (n - 1) / 2
+
+    sum_y = sum_yy = 0.0
+    block_rows = _block_rows(n, max_memory)
+    for start in range(0, n, block_rows):
+        y = np.asarray(distances[start:start + block_rows], dtype=float)
+        sum_y += y.sum()
+        sum_yy += np.einsum('ij,ij->', y, y)
+    sum_y, sum_yy = sum_y / 2, sum_yy / 2
+
+    sum_x, sum_xx, sum_xy = _pair_sums(_SortedColumn(values), distances,
+                                       max_memory)
+    denominator = np.sqrt((n_pairs * sum_xx - sum_x ** 2) *
+                          (n_pairs * sum_yy - sum_y ** 2))
+    if not denominator > 0:
+        raise ValueError(
+            "The Mantel correlation is undefined because the distances in "
+            "the distance matrix or the metadata column are all equal.")
+
+    def correlation(sum_xy):
+        return (n_pairs * sum_xy - sum_x * sum_y) / denominator
+
+    statistic = correlation(sum_xy)
+    if permutations == 0:
+        return statistic, np.nan
+
+    # The sums of x and x^2 do not depend on the ordering of the values, so
+    # only the cross term is recomputed for each permutation.
+    rng = np.random.default_rng(random_seed)
+    permuted = np.empty(permutations)
+    for i in range(permutations):
+        column = _SortedColumn(rng.permutation(values))
+        permuted[i] = correlation(
+            _pair_sums(column, distances, max_memory, cross_only=True))
+
+    if alternative == 'two-sided':
+        extreme = np.abs(permuted) >= np.abs(statistic)
+    elif alternative == 'greater':
+        extreme = permuted >= statistic
+    elif alternative == 'less':
+        extreme = permuted <= statistic
+    else:
+        raise ValueError("Unknown alternative hypothesis %r." % alternative)
+    p_value = (extreme.sum() + 1) / (permutations + 1)
+    return statistic, p_value
+
+
+def mantel(output_dir: str, distance_matrix: skbio.DistanceMatrix,
+           metadata: qiime2.NumericMetadataColumn,
+           permutations: int = 999, alternative: str = 'two-sided',
+           max_memory: int = None, random_seed: int = None) -> None:
+    ids = distance_matrix.ids
+    if len(ids) < 3:
+        raise ValueError(
+            "The Mantel test requires at least 3 IDs, but the distance "
+            "matrix contains %d." % len(ids))
+
+    metadata = _align(metadata, ids)
+    _check_missing(metadata)
+    values = metadata.to_series().reindex(ids).values
+
+    statistic, p_value = _mantel(distance_matrix.data, values,
+                                 permutations=permutations,
+                                 alternative=alternative,
+                                 max_memory=max_memory,
+                                 random_seed=random_seed)
+
+    result = pd.Series({'Method': 'Pearson',
+                        'Sample size': len(ids),
+                        'Permutations': permutations,
+                        'Alternative hypothesis': alternative,
+                        'Mantel r statistic': statistic,
+                        'p-value': p_value},
+                       name='Mantel test results')
+    result.index.name = 'Statistic'
+    result.to_csv(os.path.join(output_dir, 'mantel.tsv'), sep='\t')
+
+    result_html = q2templates.df_to_html(result.to_frame())
+    index = os.path.join(TEMPLATES, 'mantel', 'index.html')
+    q2templates.render(index, output_dir,
+                       context={'result': result_html,
+                                'column': metadata.name})
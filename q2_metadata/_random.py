@@ -11,13 +11,54 @@ import numpy as np
 import pandas as pd
 
 
+def _sort_keys(n_columns, n, random_seed=None):
+    """Random sort keys, one row of ``n`` per output column.
+
+    Each row is drawn from its own child of ``SeedSequence(random_seed)``,
+    so row ``i`` depends only on the seed and ``i``. Any subset of the
+    columns can therefore be regenerated independently (e.g., in separate
+    worker processes) and match a serial run exactly.
+    """
+    children = np.random.SeedSequence(random_seed).spawn(n_columns)
+    keys = np.empty((n_columns, n))
+    for row, child in zip(keys, children):
+        np.random.default_rng(child).random(out=row)
+    return keys
+
+
+def _strata_codes(strata, ids):
+    """Integer code of each ID's stratum, in the order of ``ids``."""
+    strata = strata.to_series()
+    unknown = ids.difference(strata.index)
+    if len(unknown) > 0:
+        raise ValueError(
+            "The strata column must contain all IDs of the metadata column "
+            "being shuffled. IDs missing from the strata column: %s"
+            % ', '.join(sorted(unknown)))
+    strata = strata.loc[ids]
+    missing = strata.index[strata.isna()]
+    if len(missing) > 0:
+        raise ValueError(
+            "Encountered missing value(s) in the strata column. Every ID "
+            "must be assigned to a stratum. IDs with missing values: %s"
+            % ', '.join(sorted(missing)))
+    return pd.factorize(strata)[0]
+
+
 def shuffle_groups(metadata: qiime2.CategoricalMetadataColumn,
                    n_columns: int = 3,
                    md_column_name_prefix: str = 'shuffled.grouping.',
                    md_column_values_prefix: str = 'fake.group.',
-                   encode_sample_size: bool = False
+                   encode_sample_size: bool = False,
+                   random_seed: int = None,
+                   strata: qiime2.CategoricalMetadataColumn = None
                    ) -> pd.DataFrame:
 
+    if n_columns < 1:
+        raise ValueError(
+            "The number of shuffled columns must be at least 1, but %d was "
+            "provided." % n_columns)
+
     input_column_name = metadata.name
     df = metadata.to_dataframe()
     group_sample_size = df[input_column_name].value_counts()
@@ -31,16 +72,24 @@ def shuffle_groups(metadata: qiime2.CategoricalMetadataColumn,
         else:
             value_mapping[value] = '%s%d' % (md_column_values_prefix, i)
 
-    first_column_id = '%s0' % md_column_name_prefix
-    df[first_column_id] = df[input_column_name].map(value_mapping)
-
-    df[first_column_id] = \
-        np.random.permutation(df[first_column_id].values)
-
-    for i in range(1, n_columns):
-        column_id = '%s%d' % (md_column_name_prefix, i)
-        df[column_id] = \
-            np.random.permutation(df[first_column_id].values)
+    values = df[input_column_name].map(value_mapping).values
 
-    df = df.drop(input_column_name, axis=1)
-    return df
+    # All permutations are drawn at once, one row of random sort keys per
+    # output column, and assembled into a single block rather than inserted
+    # into the DataFrame column by column.
+    keys = _sort_keys(n_columns, len(values), random_seed)
+    if strata is None:
+        permutations = np.argsort(keys, axis=1)
+    else:
+        # Sorting on (stratum, key) lays each stratum out as a contiguous,
+        # randomly ordered segment. Scattering the segments back onto the
+        # stably sorted positions of the same strata permutes values only
+        # within each stratum.
+        codes = _strata_codes(strata, df.index)
+        order = np.lexsort((keys, np.broadcast_to(codes, keys.shape)),
+                           axis=1)
+        permutations = np.empty_like(order)
+        permutations[:, np.argsort(codes, kind='stable')] = order
+    columns = ['%s%d' % (md_column_name_prefix, i) for i in range(n_columns)]
+    return pd.DataFrame(values[permutations].T, index=df.index,
+                        columns=columns)
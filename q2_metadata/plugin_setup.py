@@ -13,10 +13,16 @@ from q2_types.metadata import ImmutableMetadata
 import qiime2.plugin
 from qiime2.plugin import (
     Int, Categorical, MetadataColumn, model, Numeric, Plugin, SemanticType,
-    Str, Bool, Metadata, ValidationError,
+    Str, Bool, Metadata, ValidationError, Choices, Range, List, Collection,
+    Float,
 )
 
-from . import tabulate, distance_matrix, shuffle_groups, merge, __version__
+from . import (tabulate, distance_matrix, distance_matrices,
+               categorical_distance_matrix, metadata_distance_matrix,
+               gower_distance_matrix, haversine_distance_matrix,
+               sparse_distance_matrix, grouped_distance_matrices,
+               temporal_distance_matrix, update_distance_matrix, mantel,
+               shuffle_groups, merge, __version__)
 
 plugin = Plugin(
     name='metadata',
@@ -30,19 +36,320 @@ plugin = Plugin(
     short_description='Plugin for working with Metadata.'
 )
 
+# Parameters shared by every method that computes a dense distance matrix
+# block by block.
+_BLOCKED_PARAMETERS = {
+    'precision': Str % Choices('float64', 'float32'),
+    'memory_map': Bool,
+    'max_memory': Int % Range(1, None),
+}
+
+_BLOCKED_PARAMETER_DESCRIPTIONS = {
+    'precision': 'Floating point precision of the distances. float32 '
+                 'halves the memory required for the distance matrix and is '
+                 'sufficient for values with up to 7 significant digits.',
+    'memory_map': 'If true, the distances are written block by block to a '
+                  'memory-mapped temporary file instead of being held in '
+                  'memory. This allows distance matrices larger than the '
+                  'available RAM to be computed.',
+    'max_memory': 'Maximum memory, in megabytes, to use for each block of '
+                  'distances computed at once. This is in addition to the '
+                  'memory held by the distance matrix itself. By default, '
+                  'blocks of 1024 rows are computed.',
+}
+
 plugin.methods.register_function(
     function=distance_matrix,
-    inputs={},
-    parameters={'metadata': MetadataColumn[Numeric]},
+    inputs={'reference': DistanceMatrix},
+    parameters={'metadata': MetadataColumn[Numeric],
+                **_BLOCKED_PARAMETERS,
+                'cache_dir': Str,
+                'transform': Str % Choices('none', 'rank', 'log', 'zscore'),
+                'resolution': Float % Range(0, None, inclusive_start=False),
+                'missing': Str % Choices('error', 'drop')},
+    input_descriptions={'reference': 'If provided, the output contains '
+                                     'exactly the IDs of this distance '
+                                     'matrix, in the same order, so that it '
+                                     'can be compared with it directly. The '
+                                     'metadata column must contain all of '
+                                     'these IDs, and any other IDs in it '
+                                     'are ignored. With `missing` set to '
+                                     '`drop`, IDs of this distance matrix '
+                                     'that have missing values are omitted '
+                                     'from the output, which keeps the '
+                                     'order of the remaining IDs.'},
     parameter_descriptions={'metadata': 'Numeric metadata column to compute '
-                                        'pairwise Euclidean distances from'},
+                                        'pairwise Euclidean distances from',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS,
+                            'cache_dir': 'Directory in which to cache '
+                                         'distance matrices. The cache is '
+                                         'keyed by the IDs and values of '
+                                         'the metadata column and the '
+                                         'distance settings, so rerunning '
+                                         'on unchanged input reuses the '
+                                         'stored distances instead of '
+                                         'recomputing them. By default, no '
+                                         'cache is used.',
+                            'transform': 'Transformation applied to the '
+                                         'metadata values before computing '
+                                         'distances: `rank` replaces values '
+                                         'with their ranks (tied values '
+                                         'receive their mean rank), `log` '
+                                         'takes the natural logarithm of '
+                                         '(positive) values, and `zscore` '
+                                         'centers values on their mean and '
+                                         'scales them by their standard '
+                                         'deviation.',
+                            'resolution': 'If provided, distances are '
+                                          'stored in `cache_dir` as compact '
+                                          '8- or 16-bit integer multiples '
+                                          'of this spacing, which makes '
+                                          'cached distance matrices 4-8 '
+                                          'times smaller and lets both '
+                                          'precisions share them. The '
+                                          '(transformed) values must lie on '
+                                          'a grid with this spacing (e.g., 1 '
+                                          'for ages in whole years), with at '
+                                          'most 65536 distinct levels. '
+                                          'Requires `cache_dir`.',
+                            'missing': 'How to handle IDs with missing '
+                                       'values: `error` raises an error and '
+                                       '`drop` leaves them out of the '
+                                       'distance matrix.'},
     outputs=[('distance_matrix', DistanceMatrix)],
     name='Create a distance matrix from a numeric Metadata column',
     description='Create a distance matrix from a numeric metadata column. '
                 'The Euclidean distance is computed between each pair of '
                 'samples or features in the column.\n\n'
-                'Tip: the distance matrix produced by this method can be used '
-                'as input to the Mantel test available in `q2-diversity`.'
+                'Tip: to test the correlation between a numeric metadata '
+                'column and a distance matrix, use the `mantel` visualizer '
+                'of this plugin, which computes the metadata distances on '
+                'the fly instead of storing them.'
+)
+
+plugin.methods.register_function(
+    function=update_distance_matrix,
+    inputs={'distance_matrix': DistanceMatrix},
+    parameters={'metadata': MetadataColumn[Numeric],
+                **_BLOCKED_PARAMETERS,
+                'transform': Str % Choices('none', 'log')},
+    input_descriptions={'distance_matrix': 'A distance matrix previously '
+                                           'created with `distance-matrix` '
+                                           'from the same metadata column '
+                                           'and with the `transform` given '
+                                           'here. Distance matrices created '
+                                           'with the `rank` or `zscore` '
+                                           'transforms cannot be updated, '
+                                           'because those transforms depend '
+                                           'on every value in the column.'},
+    parameter_descriptions={'metadata': 'Numeric metadata column containing '
+                                        'the IDs in the distance matrix and '
+                                        'any new IDs to add to it.',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS,
+                            'transform': 'The transform that was used to '
+                                         'create the distance matrix. See '
+                                         '`distance-matrix`.'},
+    outputs=[('updated_distance_matrix', DistanceMatrix)],
+    output_descriptions={
+        'updated_distance_matrix': 'The distance matrix extended with the '
+                                   'new IDs.'},
+    name='Add new samples to a distance matrix from a numeric Metadata column',
+    description='Extend a distance matrix created by `distance-matrix` with '
+                'the IDs in the metadata column that it does not yet '
+                'contain. Existing distances are reused as they are, and '
+                'only the distances involving the new IDs are computed. The '
+                'new IDs are appended after the existing ones.'
+)
+
+plugin.methods.register_function(
+    function=distance_matrices,
+    inputs={},
+    parameters={'metadata': Metadata,
+                'columns': List[Str],
+                **_BLOCKED_PARAMETERS,
+                'transform': Str % Choices('none', 'rank', 'log', 'zscore')},
+    parameter_descriptions={'metadata': 'Metadata containing the numeric '
+                                        'columns to compute pairwise '
+                                        'Euclidean distances from.',
+                            'columns': 'Names of the numeric columns to '
+                                       'compute distance matrices from. By '
+                                       'default, every numeric column is '
+                                       'used.',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS,
+                            'transform': 'Transformation applied to the '
+                                         'values of each column before '
+                                         'computing distances. See '
+                                         '`distance-matrix`.'},
+    outputs=[('distance_matrices', Collection[DistanceMatrix])],
+    output_descriptions={
+        'distance_matrices': 'One distance matrix per column, keyed by '
+                             'column name.'},
+    name='Create distance matrices from several numeric Metadata columns',
+    description='Create one distance matrix per numeric metadata column in '
+                'a single run. This is equivalent to running '
+                '`distance-matrix` on each column, but the metadata is '
+                'loaded and validated only once.'
+)
+
+plugin.methods.register_function(
+    function=grouped_distance_matrices,
+    inputs={},
+    parameters={'metadata': MetadataColumn[Numeric],
+                'group_by': MetadataColumn[Categorical],
+                **_BLOCKED_PARAMETERS},
+    parameter_descriptions={'metadata': 'Numeric metadata column to compute '
+                                        'pairwise Euclidean distances from.',
+                            'group_by': 'Categorical metadata column '
+                                        'defining the groups (e.g., '
+                                        'subjects) within which distances '
+                                        'are computed.',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS},
+    outputs=[('distance_matrices', Collection[DistanceMatrix])],
+    output_descriptions={
+        'distance_matrices': 'One distance matrix per group, keyed by group '
+                             'name.'},
+    name='Create within-group distance matrices from a numeric Metadata '
+         'column',
+    description='Create one distance matrix per group from a numeric '
+                'metadata column. Distances are only computed between '
+                'samples or features in the same group, so pairs from '
+                'different groups are never computed or stored.'
+)
+
+plugin.methods.register_function(
+    function=categorical_distance_matrix,
+    inputs={},
+    parameters={'metadata': MetadataColumn[Categorical],
+                **_BLOCKED_PARAMETERS},
+    parameter_descriptions={'metadata': 'Categorical metadata column to '
+                                        'compute pairwise distances from.',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS},
+    outputs=[('distance_matrix', DistanceMatrix)],
+    name='Create a distance matrix from a categorical Metadata column',
+    description='Create a distance matrix from a categorical metadata '
+                'column. The distance between two samples or features is 0 '
+                'if they have the same value in the column and 1 otherwise.'
+)
+
+plugin.methods.register_function(
+    function=temporal_distance_matrix,
+    inputs={},
+    parameters={'metadata': MetadataColumn[Categorical],
+                'unit': Str % Choices('seconds', 'minutes', 'hours', 'days'),
+                **_BLOCKED_PARAMETERS},
+    parameter_descriptions={'metadata': 'Metadata column of ISO 8601 dates '
+                                        'or timestamps (e.g., 2021-03-14 or '
+                                        '2021-03-14T15:09:26) to compute '
+                                        'pairwise time differences from.',
+                            'unit': 'The unit of time in which distances '
+                                    'are reported.',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS},
+    outputs=[('distance_matrix', DistanceMatrix)],
+    name='Create a distance matrix from a date or timestamp Metadata column',
+    description='Create a distance matrix from a metadata column of ISO '
+                '8601 dates or timestamps. The distance between two samples '
+                'or features is the absolute time between them. Timestamps '
+                'with a time zone are converted to UTC, and those without a '
+                'time zone are assumed to be in UTC.'
+)
+
+plugin.methods.register_function(
+    function=metadata_distance_matrix,
+    inputs={},
+    parameters={'metadata': Metadata,
+                'metric': Str % Choices('euclidean', 'manhattan',
+                                        'chebyshev', 'cosine',
+                                        'mahalanobis'),
+                'standardize': Bool,
+                'weights': List[Float % Range(0, None)],
+                'missing': Str % Choices('error', 'drop', 'pairwise'),
+                **_BLOCKED_PARAMETERS},
+    parameter_descriptions={'metadata': 'Metadata whose numeric columns are '
+                                        'used to compute pairwise distances. '
+                                        'Categorical columns are ignored.',
+                            'metric': 'The distance metric to apply across '
+                                      'the numeric columns. The Mahalanobis '
+                                      'distance accounts for the '
+                                      'covariance between columns.',
+                            'standardize': 'If true, each numeric column is '
+                                           'centered on its mean and scaled '
+                                           'by its standard deviation '
+                                           'before computing distances, so '
+                                           'that columns measured on '
+                                           'different scales contribute '
+                                           'equally.',
+                            'weights': 'Non-negative weight of each numeric '
+                                       'column, in the order the columns '
+                                       'appear in the metadata. For example, '
+                                       'the weighted Euclidean distance is '
+                                       'sqrt(sum(w * (x - y)^2)). Cannot be '
+                                       'used with the Mahalanobis distance. '
+                                       'By default, all columns are weighted '
+                                       'equally.',
+                            'missing': 'How to handle IDs with missing '
+                                       'values: `error` raises an error, '
+                                       '`drop` leaves them out of the '
+                                       'distance matrix, and `pairwise` '
+                                       'compares each pair of IDs over the '
+                                       'columns in which both have values. '
+                                       'With `pairwise`, Euclidean and '
+                                       'Manhattan distances are scaled up '
+                                       'in proportion to the (weighted) '
+                                       'columns that are missing. Cannot be '
+                                       'used with the Mahalanobis distance.',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS},
+    outputs=[('distance_matrix', DistanceMatrix)],
+    name='Create a distance matrix from numeric Metadata columns',
+    description='Create a distance matrix from all numeric columns of the '
+                'metadata. The selected distance metric is computed between '
+                'each pair of samples or features across those columns.'
+)
+
+plugin.methods.register_function(
+    function=gower_distance_matrix,
+    inputs={},
+    parameters={'metadata': Metadata,
+                'missing': Str % Choices('error', 'drop', 'pairwise'),
+                **_BLOCKED_PARAMETERS},
+    parameter_descriptions={'metadata': 'Metadata whose numeric and '
+                                        'categorical columns are used to '
+                                        'compute pairwise Gower distances.',
+                            'missing': 'How to handle IDs with missing '
+                                       'values: `error` raises an error, '
+                                       '`drop` leaves them out of the '
+                                       'distance matrix, and `pairwise` '
+                                       'averages the contributions of only '
+                                       'the columns in which both IDs have '
+                                       'values.',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS},
+    outputs=[('distance_matrix', DistanceMatrix)],
+    name='Create a Gower distance matrix from mixed-type Metadata',
+    description='Create a Gower distance matrix from the numeric and '
+                'categorical columns of the metadata. Each numeric column '
+                'contributes the absolute difference between two values '
+                'divided by the range of the column, and each categorical '
+                'column contributes 0 if two values are equal and 1 '
+                'otherwise. The distance between two samples or features is '
+                'the mean contribution over all columns.'
+)
+
+plugin.methods.register_function(
+    function=haversine_distance_matrix,
+    inputs={},
+    parameters={'latitude': MetadataColumn[Numeric],
+                'longitude': MetadataColumn[Numeric],
+                **_BLOCKED_PARAMETERS},
+    parameter_descriptions={'latitude': 'Numeric metadata column containing '
+                                        'latitudes in decimal degrees.',
+                            'longitude': 'Numeric metadata column containing '
+                                         'longitudes in decimal degrees.',
+                            **_BLOCKED_PARAMETER_DESCRIPTIONS},
+    outputs=[('distance_matrix', DistanceMatrix)],
+    name='Create a geographic distance matrix from latitude and longitude',
+    description='Create a distance matrix of great-circle distances, in '
+                'kilometers, from latitude and longitude metadata columns. '
+                'Distances are computed with the haversine formula on a '
+                'sphere with the mean radius of the Earth.'
 )
 
 plugin.visualizers.register_function(
@@ -63,6 +370,41 @@ plugin.visualizers.register_function(
                 'exporting to common file formats.',
 )
 
+plugin.visualizers.register_function(
+    function=mantel,
+    inputs={'distance_matrix': DistanceMatrix},
+    parameters={'metadata': MetadataColumn[Numeric],
+                'permutations': Int % Range(0, None),
+                'alternative': Str % Choices('two-sided', 'greater', 'less'),
+                'max_memory': Int % Range(1, None),
+                'random_seed': Int % Range(0, None)},
+    input_descriptions={'distance_matrix': 'Distance matrix to correlate '
+                                           'with the metadata column.'},
+    parameter_descriptions={
+        'metadata': 'Numeric metadata column whose pairwise Euclidean '
+                    'distances are correlated with the distance matrix. It '
+                    'must contain every ID in the distance matrix.',
+        'permutations': 'The number of permutations used to compute the '
+                        'p-value. If 0, no p-value is computed.',
+        'alternative': 'The alternative hypothesis of the test.',
+        'max_memory': 'Maximum memory, in megabytes, to use for each block '
+                      'of metadata distances computed at once.',
+        'random_seed': 'Seed for the random number generator used to draw '
+                       'the permutations. Runs with the same seed and input '
+                       'produce the same p-value. By default, a new random '
+                       'seed is used for each run.'},
+    name='Mantel test between a distance matrix and a numeric Metadata '
+         'column',
+    description='Compute the Pearson correlation between a distance matrix '
+                'and the pairwise Euclidean distances of a numeric metadata '
+                'column, and assess its significance with a Mantel '
+                'permutation test. The metadata distances are computed '
+                'block by block for each permutation and are never stored '
+                'as a distance matrix, so this requires about half the '
+                'memory of running `distance-matrix` followed by a Mantel '
+                'test on both distance matrices.'
+)
+
 ArtificialGrouping = \
     SemanticType('ArtificialGrouping', variant_of=SampleData.field['type'])
 
@@ -109,14 +451,115 @@ def _2(ff: ArtificialGroupingFormat) -> (qiime2.Metadata):
     return qiime2.Metadata.load(str(ff))
 
 
+SparseDistanceMatrix = SemanticType('SparseDistanceMatrix')
+
+plugin.register_semantic_types(SparseDistanceMatrix)
+
+
+class SparseDistanceMatrixFormat(model.TextFileFormat):
+    HEADER = ['id1', 'id2', 'distance']
+
+    def _validate_(self, level):
+        n_records = {'min': 10, 'max': None}[level]
+        with self.open() as fh:
+            header = fh.readline().rstrip('\n').split('\t')
+            if header != self.HEADER:
+                raise ValidationError(
+                    'Header must be %r, found %r.'
+                    % ('\t'.join(self.HEADER), '\t'.join(header)))
+
+            for line_number, line in enumerate(fh, start=2):
+                if n_records is not None and line_number > n_records + 1:
+                    break
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 3:
+                    raise ValidationError(
+                        'Line %d must contain 3 tab-separated fields, found '
+                        '%d.' % (line_number, len(fields)))
+                try:
+                    distance = float(fields[2])
+                except ValueError:
+                    raise ValidationError(
+                        'Distance on line %d is not a number: %r.'
+                        % (line_number, fields[2]))
+                if not distance >= 0:
+                    raise ValidationError(
+                        'Distance on line %d must be non-negative, found %r.'
+                        % (line_number, fields[2]))
+
+
+SparseDistanceMatrixDirectoryFormat = model.SingleFileDirectoryFormat(
+    'SparseDistanceMatrixDirectoryFormat', 'sparse-distance-matrix.tsv',
+    SparseDistanceMatrixFormat)
+
+plugin.register_formats(SparseDistanceMatrixFormat,
+                        SparseDistanceMatrixDirectoryFormat)
+
+plugin.register_semantic_type_to_format(
+    SparseDistanceMatrix,
+    artifact_format=SparseDistanceMatrixDirectoryFormat)
+
+
+@plugin.register_transformer
+def _3(df: pd.DataFrame) -> (SparseDistanceMatrixFormat):
+    ff = SparseDistanceMatrixFormat()
+    df.to_csv(str(ff), sep='\t', index=False,
+              columns=SparseDistanceMatrixFormat.HEADER)
+    return ff
+
+
+@plugin.register_transformer
+def _4(ff: SparseDistanceMatrixFormat) -> (pd.DataFrame):
+    # IDs such as 'NA' or 'nan' are valid and must not be read as missing.
+    return pd.read_csv(str(ff), sep='\t', keep_default_na=False,
+                       dtype={'id1': str, 'id2': str, 'distance': float})
+
+
+plugin.methods.register_function(
+    function=sparse_distance_matrix,
+    inputs={},
+    parameters={'metadata': MetadataColumn[Numeric],
+                'n_neighbors': Int % Range(1, None),
+                'max_distance': Float % Range(0, None)},
+    parameter_descriptions={'metadata': 'Numeric metadata column to compute '
+                                        'pairwise Euclidean distances from.',
+                            'n_neighbors': 'The number of nearest neighbors '
+                                           'to report for each sample or '
+                                           'feature. Mutually exclusive '
+                                           'with `max_distance`.',
+                            'max_distance': 'Report every pair of samples or '
+                                            'features whose distance is at '
+                                            'most this value. Mutually '
+                                            'exclusive with `n_neighbors`.'},
+    outputs=[('sparse_distance_matrix', SparseDistanceMatrix)],
+    output_descriptions={
+        'sparse_distance_matrix': 'The selected pairs of samples or features '
+                                  'and the distances between them.'},
+    name='Create a sparse distance matrix from a numeric Metadata column',
+    description='Compute the Euclidean distances between only the nearby '
+                'pairs of samples or features in a numeric metadata column. '
+                'Either the `n-neighbors` nearest neighbors of each sample '
+                'or feature, or all pairs within `max-distance` of each '
+                'other, are reported. Only these pairs are stored, so the '
+                'result can be far smaller than the output of '
+                '`distance-matrix`. The result is a tab-separated list of '
+                '(id1, id2, distance) records. With `n-neighbors`, there are '
+                '`n-neighbors` records per ID and id2 is one of the nearest '
+                'neighbors of id1. With `max-distance`, each pair is '
+                'reported once.'
+)
+
+
 plugin.methods.register_function(
     function=shuffle_groups,
     inputs={},
     parameters={'metadata': MetadataColumn[Categorical],
-                'n_columns': Int,
+                'n_columns': Int % Range(1, None),
                 'md_column_name_prefix': Str,
                 'md_column_values_prefix': Str,
-                'encode_sample_size': Bool
+                'encode_sample_size': Bool,
+                'random_seed': Int % Range(0, None),
+                'strata': MetadataColumn[Categorical]
                 },
     parameter_descriptions={
         'metadata': ('Categorical metadata column to shuffle.'),
@@ -128,6 +571,17 @@ plugin.methods.register_function(
         'encode_sample_size': ('If true, the sample size of each metadata '
                                'group will be appended to the shuffled '
                                'metadata column values.'),
+        'random_seed': ('Seed for the random number generator. Runs with '
+                        'the same seed and input produce the same shuffled '
+                        'columns. By default, a new random seed is used for '
+                        'each run.'),
+        'strata': ('Categorical metadata column assigning each sample to a '
+                   'stratum (e.g., a subject or sequencing run). If '
+                   'provided, values are only shuffled among samples in the '
+                   'same stratum, so the counts of each value within each '
+                   'stratum are preserved. This column must contain all '
+                   'samples in the shuffled metadata column, without '
+                   'missing values.'),
         },
     output_descriptions={
         'shuffled_groups': 'Randomized metadata columns'},
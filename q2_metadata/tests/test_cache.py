@@ -0,0 +1,127 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+import pandas as pd
+import qiime2
+
+from q2_metadata import distance_matrix
+from q2_metadata._cache import cache_key, load_cached, store_cached
+from q2_metadata._distance import _column_distance_matrix
+
+
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(
+            prefix='q2-metadata-test-')
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.series = pd.Series([1.0, 2.0, 4.0], name='number',
+                                index=pd.Index(['sample1', 'sample2',
+                                                'sample3'], name='id'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_cache_key(self):
+        key = cache_key(self.series, precision='float64')
+
+        self.assertEqual(key, cache_key(self.series.copy(),
+                                        precision='float64'))
+        self.assertNotEqual(key, cache_key(self.series,
+                                           precision='float32'))
+        self.assertNotEqual(key, cache_key(self.series.iloc[::-1],
+                                           precision='float64'))
+        self.assertNotEqual(key, cache_key(self.series + 1,
+                                           precision='float64'))
+
+    def test_round_trip(self):
+        distances = np.arange(9, dtype=np.float32).reshape(3, 3)
+
+        self.assertIsNone(load_cached(self.cache_dir, 'abc'))
+        store_cached(self.cache_dir, 'abc', distances)
+
+        obs = load_cached(self.cache_dir, 'abc')
+        self.assertEqual(obs.dtype, np.float32)
+        np.testing.assert_array_equal(obs, distances)
+        self.assertIsInstance(
+            load_cached(self.cache_dir, 'abc', memory_map=True), np.memmap)
+        self.assertEqual(os.listdir(self.cache_dir), ['abc.npy'])
+
+    def test_distance_matrix_cached(self):
+        md = qiime2.NumericMetadataColumn(self.series)
+        exp = distance_matrix(md, cache_dir=self.cache_dir)
+
+        with unittest.mock.patch(
+                'q2_metadata._distance._column_distance_matrix',
+                wraps=_column_distance_matrix) as compute:
+            obs = distance_matrix(md, cache_dir=self.cache_dir)
+            compute.assert_not_called()
+            self.assertEqual(exp, obs)
+
+            distance_matrix(md, cache_dir=self.cache_dir,
+                            precision='float32')
+            compute.assert_called_once()
+
+    def test_distance_matrix_quantized_cache(self):
+        md = qiime2.NumericMetadataColumn(self.series)
+        exp = distance_matrix(md)
+
+        obs = distance_matrix(md, cache_dir=self.cache_dir, resolution=1.0)
+        cached = distance_matrix(md, cache_dir=self.cache_dir,
+                                 resolution=1.0)
+
+        self.assertEqual(exp, obs)
+        self.assertEqual(exp, cached)
+        (entry,) = os.listdir(self.cache_dir)
+        self.assertEqual(np.load(os.path.join(self.cache_dir, entry)).dtype,
+                         np.uint8)
+
+    def test_distance_matrix_quantized_cache_shared_by_precisions(self):
+        md = qiime2.NumericMetadataColumn(self.series)
+
+        obs64 = distance_matrix(md, cache_dir=self.cache_dir, resolution=1.0)
+        obs32 = distance_matrix(md, cache_dir=self.cache_dir, resolution=1.0,
+                                precision='float32')
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertEqual(obs64.dtype, np.float64)
+        self.assertEqual(obs32.dtype, np.float32)
+        np.testing.assert_array_equal(obs64.data, obs32.data)
+
+    def test_resolution(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([0.3, 0.1, 0.6], name='depth',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+
+        obs = distance_matrix(md, cache_dir=self.cache_dir,
+                              resolution=0.1)
+
+        np.testing.assert_allclose(obs.data, [[0.0, 0.2, 0.3],
+                                              [0.2, 0.0, 0.5],
+                                              [0.3, 0.5, 0.0]])
+
+    def test_resolution_off_grid(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 2.5, 3.0], name='age',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, '1 value.*resolution'):
+            distance_matrix(md, cache_dir=self.cache_dir, resolution=1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
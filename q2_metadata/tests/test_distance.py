@@ -6,14 +6,36 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import tracemalloc
 import unittest
+import unittest.mock
 
 import pandas as pd
 import numpy as np
+import scipy.spatial
 import skbio
 import qiime2
 
-from q2_metadata import distance_matrix
+from q2_metadata import (distance_matrix, distance_matrices,
+                         categorical_distance_matrix, metadata_distance_matrix,
+                         gower_distance_matrix, haversine_distance_matrix,
+                         sparse_distance_matrix, grouped_distance_matrices,
+                         temporal_distance_matrix, update_distance_matrix)
+from q2_metadata._distance import (_SortedColumn, _GroupedColumn,
+                                   _QuantizedColumn, _NumericTable,
+                                   _GowerTable, _GeographicTable,
+                                   _block_rows)
+
+
+def _peak_block_memory(engine, max_memory):
+    """Peak memory in MB used by ``engine.dense`` beyond its result."""
+    tracemalloc.start()
+    try:
+        result = engine.dense(max_memory=max_memory)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (peak - result.nbytes) / 2 ** 20
 
 
 class DistanceMatrixTests(unittest.TestCase):
@@ -59,6 +81,159 @@ class DistanceMatrixTests(unittest.TestCase):
 
         self.assertEqual(exp, obs)
 
+    def test_float32_precision(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.5, 2.0, 3.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+        exp = skbio.DistanceMatrix(np.array([[0.0, 0.5, 1.5],
+                                             [0.5, 0.0, 1.0],
+                                             [1.5, 1.0, 0.0]],
+                                            dtype=np.float32),
+                                   ids=['sample1', 'sample2', 'sample3'])
+
+        obs = distance_matrix(md, precision='float32')
+
+        self.assertEqual(obs.dtype, np.float32)
+        self.assertEqual(exp, obs)
+
+    def test_memory_map(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.5, 2.0, 3.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0.0, 0.5, 1.5],
+                                    [0.5, 0.0, 1.0],
+                                    [1.5, 1.0, 0.0]],
+                                   ids=['sample1', 'sample2', 'sample3'])
+
+        obs = distance_matrix(md, memory_map=True)
+
+        self.assertIsInstance(obs.data, np.memmap)
+        self.assertEqual(exp, obs)
+
+    def test_max_memory(self):
+        values = np.arange(600, dtype=float) ** 1.5
+        md = qiime2.NumericMetadataColumn(
+            pd.Series(values, name='number',
+                      index=pd.Index(['s%d' % i for i in range(600)],
+                                     name='id'))
+        )
+        exp = distance_matrix(md)
+
+        # 1 MB fits 218 rows of 600 float64 values, so several blocks are
+        # needed.
+        obs = distance_matrix(md, max_memory=1)
+
+        self.assertEqual(exp, obs)
+
+    def test_reference(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, np.nan, 3.0, 7.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3',
+                                      'sample4'], name='id'))
+        )
+        reference = skbio.DistanceMatrix([[0.0, 1.0], [1.0, 0.0]],
+                                         ids=['sample4', 'sample1'])
+        exp = skbio.DistanceMatrix([[0.0, 6.0], [6.0, 0.0]],
+                                   ids=['sample4', 'sample1'])
+
+        # sample2 has a missing value but is not in the reference.
+        obs = distance_matrix(md, reference=reference)
+
+        self.assertEqual(exp, obs)
+
+    def test_reference_unknown_ids(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 2.0], name='number',
+                      index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+        reference = skbio.DistanceMatrix([[0.0, 1.0], [1.0, 0.0]],
+                                         ids=['sample1', 'sample5'])
+
+        with self.assertRaisesRegex(ValueError, 'metadata column: sample5'):
+            distance_matrix(md, reference=reference)
+
+    def test_drop_missing(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, np.nan, 3.0, 7.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3',
+                                      'sample4'], name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0.0, 2.0, 6.0],
+                                    [2.0, 0.0, 4.0],
+                                    [6.0, 4.0, 0.0]],
+                                   ids=['sample1', 'sample3', 'sample4'])
+
+        obs = distance_matrix(md, missing='drop')
+
+        self.assertEqual(exp, obs)
+
+    def test_drop_missing_reference(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, np.nan, 7.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample4'],
+                                     name='id'))
+        )
+        reference = skbio.DistanceMatrix(np.ones((3, 3)) - np.eye(3),
+                                         ids=['sample4', 'sample2',
+                                              'sample1'])
+        exp = skbio.DistanceMatrix([[0.0, 6.0], [6.0, 0.0]],
+                                   ids=['sample4', 'sample1'])
+
+        obs = distance_matrix(md, reference=reference, missing='drop')
+
+        self.assertEqual(exp, obs)
+
+    def test_drop_missing_all_missing(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([np.nan, np.nan], name='number',
+                      index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'no IDs remain'):
+            distance_matrix(md, missing='drop')
+
+    def test_rank_transform(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([10.0, 1000.0, 10.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0.0, 1.5, 0.0],
+                                    [1.5, 0.0, 1.5],
+                                    [0.0, 1.5, 0.0]],
+                                   ids=['sample1', 'sample2', 'sample3'])
+
+        obs = distance_matrix(md, transform='rank')
+
+        self.assertEqual(exp, obs)
+
+    def test_log_transform(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, np.e, np.e ** 3], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+
+        obs = distance_matrix(md, transform='log')
+
+        np.testing.assert_allclose(obs.data, [[0.0, 1.0, 3.0],
+                                              [1.0, 0.0, 2.0],
+                                              [3.0, 2.0, 0.0]])
+
+    def test_resolution_requires_cache_dir(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 2.0, 3.0], name='age',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'requires a cache'):
+            distance_matrix(md, resolution=1.0)
+
     def test_missing_values(self):
         md = qiime2.NumericMetadataColumn(
             pd.Series([1.0, 2.0, np.nan, 4.0], name='number',
@@ -71,5 +246,994 @@ class DistanceMatrixTests(unittest.TestCase):
             distance_matrix(md)
 
 
+class GroupedDistanceMatricesTests(unittest.TestCase):
+    def setUp(self):
+        self.md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 5.0, 2.0, 7.0, 4.0], name='time',
+                      index=pd.Index(['s1', 's2', 's3', 's4', 's5'],
+                                     name='id'))
+        )
+
+    def test_groups(self):
+        group_by = qiime2.CategoricalMetadataColumn(
+            pd.Series(['b', 'a', 'b', 'a', 'b', 'c'], name='subject',
+                      index=pd.Index(['s1', 's2', 's3', 's4', 's5', 's6'],
+                                     name='id'))
+        )
+
+        obs = grouped_distance_matrices(self.md, group_by)
+
+        self.assertEqual(set(obs), {'a', 'b'})
+        self.assertEqual(obs['a'],
+                         skbio.DistanceMatrix([[0.0, 2.0], [2.0, 0.0]],
+                                              ids=['s2', 's4']))
+        self.assertEqual(obs['b'],
+                         skbio.DistanceMatrix([[0.0, 1.0, 3.0],
+                                               [1.0, 0.0, 2.0],
+                                               [3.0, 2.0, 0.0]],
+                                              ids=['s1', 's3', 's5']))
+
+    def test_ungrouped_ids(self):
+        group_by = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'b'], name='subject',
+                      index=pd.Index(['s1', 's2', 's3'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'without a group: s4, s5'):
+            grouped_distance_matrices(self.md, group_by)
+
+    def test_missing_groups(self):
+        group_by = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'b', np.nan, 'b'], name='subject',
+                      index=pd.Index(['s1', 's2', 's3', 's4', 's5'],
+                                     name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'missing groups: s4'):
+            grouped_distance_matrices(self.md, group_by)
+
+
+class CategoricalDistanceMatrixTests(unittest.TestCase):
+    def test_mismatch(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'a', 'c'], name='group',
+                      index=pd.Index(['sample1', 'sample2', 'sample3',
+                                      'sample4'], name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0, 1, 0, 1],
+                                    [1, 0, 1, 1],
+                                    [0, 1, 0, 1],
+                                    [1, 1, 1, 0]],
+                                   ids=['sample1', 'sample2', 'sample3',
+                                        'sample4'])
+
+        obs = categorical_distance_matrix(md)
+
+        self.assertEqual(exp, obs)
+
+    def test_float32_precision(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b'], name='group',
+                      index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        obs = categorical_distance_matrix(md, precision='float32')
+
+        self.assertEqual(obs.dtype, np.float32)
+        self.assertEqual(obs['sample1', 'sample2'], 1.0)
+
+    def test_missing_values(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', np.nan, 'b'], name='group',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'missing values: sample2'):
+            categorical_distance_matrix(md)
+
+
+class SparseDistanceMatrixTests(unittest.TestCase):
+    def test_nearest_neighbors(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 10.0, 2.0, 4.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3',
+                                      'sample4'], name='id'))
+        )
+        exp = pd.DataFrame({'id1': ['sample1', 'sample2', 'sample3',
+                                    'sample4'],
+                            'id2': ['sample3', 'sample4', 'sample1',
+                                    'sample3'],
+                            'distance': [1.0, 6.0, 1.0, 2.0]})
+
+        obs = sparse_distance_matrix(md, n_neighbors=1)
+
+        pd.testing.assert_frame_equal(obs, exp, check_dtype=False)
+
+    def test_max_distance(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([4.0, 1.0, 2.0, 10.0, 3.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3',
+                                      'sample4', 'sample5'], name='id'))
+        )
+        exp = pd.DataFrame({'id1': ['sample1', 'sample1', 'sample2',
+                                    'sample2', 'sample3'],
+                            'id2': ['sample3', 'sample5', 'sample3',
+                                    'sample5', 'sample5'],
+                            'distance': [2.0, 1.0, 1.0, 2.0, 1.0]})
+
+        obs = sparse_distance_matrix(md, max_distance=2.0)
+
+        pd.testing.assert_frame_equal(obs, exp, check_dtype=False)
+
+    def test_no_pairs_within_max_distance(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 5.0], name='number',
+                      index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        obs = sparse_distance_matrix(md, max_distance=1.0)
+
+        self.assertEqual(len(obs), 0)
+        self.assertEqual(list(obs.columns), ['id1', 'id2', 'distance'])
+
+    def test_neighbors_and_max_distance(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 2.0], name='number',
+                      index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'Exactly one'):
+            sparse_distance_matrix(md, n_neighbors=1, max_distance=1.0)
+        with self.assertRaisesRegex(ValueError, 'Exactly one'):
+            sparse_distance_matrix(md)
+
+    def test_too_many_neighbors(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 2.0], name='number',
+                      index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'less than'):
+            sparse_distance_matrix(md, n_neighbors=2)
+
+    def test_missing_values(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, np.nan, 2.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'missing values: sample2'):
+            sparse_distance_matrix(md, n_neighbors=1)
+
+
+class UpdateDistanceMatrixTests(unittest.TestCase):
+    def setUp(self):
+        self.md = qiime2.NumericMetadataColumn(
+            pd.Series([4.0, 1.0, 2.0, 8.0], name='number',
+                      index=pd.Index(['sample4', 'sample1', 'sample2',
+                                      'sample3'], name='id'))
+        )
+
+    def test_new_ids(self):
+        dm = skbio.DistanceMatrix([[0.0, 1.0], [1.0, 0.0]],
+                                  ids=['sample1', 'sample2'])
+        exp = skbio.DistanceMatrix([[0.0, 1.0, 3.0, 7.0],
+                                    [1.0, 0.0, 2.0, 6.0],
+                                    [3.0, 2.0, 0.0, 4.0],
+                                    [7.0, 6.0, 4.0, 0.0]],
+                                   ids=['sample1', 'sample2', 'sample4',
+                                        'sample3'])
+
+        obs = update_distance_matrix(dm, self.md)
+
+        self.assertEqual(exp, obs)
+        # The result passes skbio's symmetry and hollowness checks.
+        skbio.DistanceMatrix(obs.data, ids=obs.ids)
+
+    def test_existing_distances_reused(self):
+        # Existing distances are copied rather than recomputed.
+        dm = skbio.DistanceMatrix([[0.0, 9.0], [9.0, 0.0]],
+                                  ids=['sample1', 'sample2'])
+
+        obs = update_distance_matrix(dm, self.md, precision='float32')
+
+        self.assertEqual(obs.dtype, np.float32)
+        self.assertEqual(obs['sample1', 'sample2'], 9.0)
+        self.assertEqual(obs['sample2', 'sample3'], 6.0)
+
+    def test_no_new_ids(self):
+        dm = distance_matrix(self.md)
+
+        obs = update_distance_matrix(dm, self.md)
+
+        self.assertEqual(dm, obs)
+
+    def test_unknown_ids(self):
+        dm = skbio.DistanceMatrix([[0.0, 1.0], [1.0, 0.0]],
+                                  ids=['sample1', 'sample5'])
+
+        with self.assertRaisesRegex(ValueError, 'metadata column: sample5'):
+            update_distance_matrix(dm, self.md)
+
+    def test_log_transform(self):
+        dm = distance_matrix(
+            qiime2.NumericMetadataColumn(self.md.to_series().iloc[1:3]),
+            transform='log')
+        exp = distance_matrix(self.md, transform='log')
+
+        obs = update_distance_matrix(dm, self.md, transform='log')
+
+        self.assertEqual(exp.filter(obs.ids), obs)
+
+    def test_whole_column_transforms(self):
+        dm = distance_matrix(self.md, transform='rank')
+
+        for transform in 'rank', 'zscore':
+            with self.assertRaisesRegex(ValueError, 'cannot be updated'):
+                update_distance_matrix(dm, self.md, transform=transform)
+
+
+class DistanceMatricesTests(unittest.TestCase):
+    def setUp(self):
+        self.md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, 2.0, 4.0], 'y': [0.0, 5.0, 5.0],
+                          'label': ['a', 'b', 'c']},
+                         index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                        name='id'))
+        )
+        self.ids = ['sample1', 'sample2', 'sample3']
+
+    def test_all_numeric_columns(self):
+        obs = distance_matrices(self.md)
+
+        self.assertEqual(set(obs), {'x', 'y'})
+        self.assertEqual(obs['x'],
+                         skbio.DistanceMatrix([[0.0, 1.0, 3.0],
+                                               [1.0, 0.0, 2.0],
+                                               [3.0, 2.0, 0.0]],
+                                              ids=self.ids))
+        self.assertEqual(obs['y'],
+                         skbio.DistanceMatrix([[0.0, 5.0, 5.0],
+                                               [5.0, 0.0, 0.0],
+                                               [5.0, 0.0, 0.0]],
+                                              ids=self.ids))
+
+    def test_selected_columns(self):
+        obs = distance_matrices(self.md, columns=['y'], precision='float32')
+
+        self.assertEqual(list(obs), ['y'])
+        self.assertEqual(obs['y'].dtype, np.float32)
+
+    def test_unknown_column(self):
+        with self.assertRaisesRegex(ValueError, "'z' is not present"):
+            distance_matrices(self.md, columns=['x', 'z'])
+
+    def test_categorical_column(self):
+        with self.assertRaisesRegex(ValueError, "'label' is not numeric"):
+            distance_matrices(self.md, columns=['label'])
+
+    def test_no_columns(self):
+        with self.assertRaisesRegex(ValueError, 'At least one column'):
+            distance_matrices(self.md, columns=[])
+
+    def test_duplicate_columns(self):
+        with self.assertRaisesRegex(ValueError, "Duplicated columns: 'x'"):
+            distance_matrices(self.md, columns=['x', 'y', 'x'])
+
+    def test_missing_values(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, np.nan], 'y': [0.0, 2.0]},
+                         index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'missing values: sample2'):
+            distance_matrices(md, columns=['y', 'x'])
+
+
+class TemporalDistanceMatrixTests(unittest.TestCase):
+    def setUp(self):
+        self.md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['2021-03-14', '2021-03-16T12:00:00',
+                       '2021-03-14T02:00:00+02:00'], name='date',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+        self.ids = ['sample1', 'sample2', 'sample3']
+
+    def test_days(self):
+        exp = skbio.DistanceMatrix([[0.0, 2.5, 0.0],
+                                    [2.5, 0.0, 2.5],
+                                    [0.0, 2.5, 0.0]], ids=self.ids)
+
+        obs = temporal_distance_matrix(self.md)
+
+        self.assertEqual(exp, obs)
+
+    def test_hours(self):
+        exp = skbio.DistanceMatrix([[0.0, 60.0, 0.0],
+                                    [60.0, 0.0, 60.0],
+                                    [0.0, 60.0, 0.0]], ids=self.ids)
+
+        obs = temporal_distance_matrix(self.md, unit='hours')
+
+        self.assertEqual(exp, obs)
+
+    def test_invalid_timestamps(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['2021-03-14', 'yesterday', '2021-13-01'], name='date',
+                      index=pd.Index(self.ids, name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError,
+                                    'invalid values: sample2, sample3'):
+            temporal_distance_matrix(md)
+
+    def test_non_iso8601_timestamps(self):
+        # Formats that pandas < 2 would otherwise parse, some ambiguously.
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['2021-03-14', '03/15/2021', 'March 16 2021'],
+                      name='date', index=pd.Index(self.ids, name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError,
+                                    'invalid values: sample2, sample3'):
+            temporal_distance_matrix(md)
+
+    def test_iso8601_variants(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['2021-03-14 00:00', '2021-03-14T12:00:00.5Z',
+                       '2021-03-15T00:00:00-0000'], name='date',
+                      index=pd.Index(self.ids, name='id'))
+        )
+
+        obs = temporal_distance_matrix(md, unit='hours')
+
+        np.testing.assert_allclose(obs.data[0], [0.0, 12.0 + 0.5 / 3600,
+                                                 24.0])
+
+
+class MetadataDistanceMatrixTests(unittest.TestCase):
+    def setUp(self):
+        self.md = qiime2.Metadata(
+            pd.DataFrame({'x': [0.0, 3.0, 1.0], 'y': [0.0, 4.0, 1.0],
+                          'label': ['a', 'b', 'c']},
+                         index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                        name='id'))
+        )
+        self.ids = ['sample1', 'sample2', 'sample3']
+
+    def test_euclidean(self):
+        r2 = np.sqrt(2)
+        r13 = np.sqrt(13)
+        exp = skbio.DistanceMatrix([[0.0, 5.0, r2],
+                                    [5.0, 0.0, r13],
+                                    [r2, r13, 0.0]], ids=self.ids)
+
+        obs = metadata_distance_matrix(self.md)
+
+        self.assertEqual(exp, obs)
+
+    def test_manhattan(self):
+        exp = skbio.DistanceMatrix([[0.0, 7.0, 2.0],
+                                    [7.0, 0.0, 5.0],
+                                    [2.0, 5.0, 0.0]], ids=self.ids)
+
+        obs = metadata_distance_matrix(self.md, metric='manhattan')
+
+        self.assertEqual(exp, obs)
+
+    def test_chebyshev(self):
+        exp = skbio.DistanceMatrix([[0.0, 4.0, 1.0],
+                                    [4.0, 0.0, 3.0],
+                                    [1.0, 3.0, 0.0]], ids=self.ids)
+
+        obs = metadata_distance_matrix(self.md, metric='chebyshev',
+                                       precision='float32')
+
+        self.assertEqual(exp, obs)
+
+    def test_cosine(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, 0.0, 2.0], 'y': [0.0, 1.0, 2.0]},
+                         index=pd.Index(self.ids, name='id'))
+        )
+        c = 1 - 1 / np.sqrt(2)
+        exp = np.array([[0.0, 1.0, c],
+                        [1.0, 0.0, c],
+                        [c, c, 0.0]])
+
+        obs = metadata_distance_matrix(md, metric='cosine')
+
+        self.assertEqual(obs.ids, tuple(self.ids))
+        np.testing.assert_allclose(obs.data, exp)
+
+    def test_standardize(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [0.0, 2.0, 4.0], 'y': [0.0, 200.0, 400.0]},
+                         index=pd.Index(self.ids, name='id'))
+        )
+        # Both columns have a standard deviation of sqrt(8/3) * their scale.
+        step = np.sqrt(2) / np.sqrt(8 / 3) * 2
+
+        obs = metadata_distance_matrix(md, standardize=True)
+
+        np.testing.assert_allclose(obs.data, [[0.0, step, 2 * step],
+                                              [step, 0.0, step],
+                                              [2 * step, step, 0.0]])
+
+    def test_weights(self):
+        exp = skbio.DistanceMatrix([[0.0, 3.0 + 8.0, 1.0 + 2.0],
+                                    [11.0, 0.0, 2.0 + 6.0],
+                                    [3.0, 8.0, 0.0]], ids=self.ids)
+
+        obs = metadata_distance_matrix(self.md, metric='manhattan',
+                                       weights=[1.0, 2.0])
+
+        self.assertEqual(exp, obs)
+
+    def test_weighted_euclidean(self):
+        obs = metadata_distance_matrix(self.md, weights=[0.0, 4.0])
+
+        self.assertAlmostEqual(obs['sample1', 'sample2'], 8.0)
+
+    def test_invalid_weights(self):
+        with self.assertRaisesRegex(ValueError, '1 weights.*2 columns'):
+            metadata_distance_matrix(self.md, weights=[1.0])
+        with self.assertRaisesRegex(ValueError, 'at least one'):
+            metadata_distance_matrix(self.md, weights=[0.0, 0.0])
+        with self.assertRaisesRegex(ValueError, 'Mahalanobis'):
+            metadata_distance_matrix(self.md, metric='mahalanobis',
+                                     weights=[1.0, 1.0])
+
+    def test_mahalanobis(self):
+        values = np.array([[1.0, 2.0], [2.0, 1.0], [4.0, 7.0],
+                           [0.0, 3.0], [5.0, 5.0]])
+        ids = ['s%d' % i for i in range(5)]
+        md = qiime2.Metadata(
+            pd.DataFrame(values, columns=['x', 'y'],
+                         index=pd.Index(ids, name='id'))
+        )
+        exp = scipy.spatial.distance.cdist(
+            values, values, metric='mahalanobis',
+            VI=np.linalg.inv(np.cov(values, rowvar=False)))
+
+        obs = metadata_distance_matrix(md, metric='mahalanobis')
+
+        np.testing.assert_allclose(obs.data, exp, atol=1e-12)
+
+    def test_mahalanobis_singular(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [0.0, 3.0, 1.0], 'y': [0.0, 6.0, 2.0]},
+                         index=pd.Index(self.ids, name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'non-singular'):
+            metadata_distance_matrix(md, metric='mahalanobis')
+
+    def test_cosine_all_zero(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, 0.0], 'y': [0.0, 0.0]},
+                         index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'all-zero.*sample2'):
+            metadata_distance_matrix(md, metric='cosine')
+
+    def test_no_numeric_columns(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'label': ['a', 'b']},
+                         index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'any numeric columns'):
+            metadata_distance_matrix(md)
+
+    def test_missing_values(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, np.nan], 'y': [0.0, 2.0]},
+                         index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'missing values: sample2'):
+            metadata_distance_matrix(md)
+
+    def test_drop_missing(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, np.nan, 4.0], 'y': [0.0, 2.0, 4.0]},
+                         index=pd.Index(self.ids, name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0.0, 5.0], [5.0, 0.0]],
+                                   ids=['sample1', 'sample3'])
+
+        obs = metadata_distance_matrix(md, missing='drop')
+
+        self.assertEqual(exp, obs)
+
+    def test_pairwise_missing(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, np.nan, 4.0], 'y': [0.0, 2.0, 4.0]},
+                         index=pd.Index(self.ids, name='id'))
+        )
+
+        obs = metadata_distance_matrix(md, metric='manhattan',
+                                       missing='pairwise')
+
+        # Pairs with sample2 share only y, so their distance is doubled.
+        np.testing.assert_allclose(obs.data, [[0.0, 4.0, 7.0],
+                                              [4.0, 0.0, 4.0],
+                                              [7.0, 4.0, 0.0]])
+
+    def test_pairwise_missing_metrics(self):
+        values = np.array([[1.0, 2.0, np.nan], [2.0, np.nan, 3.0],
+                           [4.0, 7.0, 1.0], [0.0, 3.0, 5.0]])
+        weights = [1.0, 2.0, 0.5]
+        md = qiime2.Metadata(
+            pd.DataFrame(values, columns=['x', 'y', 'z'],
+                         index=pd.Index(['s0', 's1', 's2', 's3'], name='id'))
+        )
+
+        for metric in ('euclidean', 'manhattan', 'chebyshev', 'cosine'):
+            obs = metadata_distance_matrix(md, metric=metric,
+                                           weights=weights,
+                                           missing='pairwise', max_memory=1)
+            for i, j in [(0, 1), (0, 2), (1, 3), (2, 3)]:
+                both = ~np.isnan(values[i]) & ~np.isnan(values[j])
+                u, v = values[i, both], values[j, both]
+                w = np.array(weights)[both]
+                if metric == 'euclidean':
+                    exp = np.sqrt((w * (u - v) ** 2).sum()
+                                  * sum(weights) / w.sum())
+                elif metric == 'manhattan':
+                    exp = (w * np.abs(u - v)).sum() * sum(weights) / w.sum()
+                elif metric == 'chebyshev':
+                    exp = (w * np.abs(u - v)).max()
+                else:
+                    exp = scipy.spatial.distance.cosine(u, v, w=w)
+                self.assertAlmostEqual(obs.data[i, j], exp, msg=metric)
+
+    def test_pairwise_no_shared_columns(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, np.nan], 'y': [np.nan, 2.0]},
+                         index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'no .*column'):
+            metadata_distance_matrix(md, missing='pairwise')
+
+    def test_pairwise_mahalanobis(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [1.0, np.nan, 0.0], 'y': [0.0, 2.0, 1.0]},
+                         index=pd.Index(self.ids, name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'Mahalanobis.*missing'):
+            metadata_distance_matrix(md, metric='mahalanobis',
+                                     missing='pairwise')
+
+
+class GowerDistanceMatrixTests(unittest.TestCase):
+    def test_mixed_columns(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'x': [0.0, 2.0, 4.0], 'c': [5.0, 5.0, 5.0],
+                          'label': ['a', 'b', 'a']},
+                         index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                        name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0.0, 1.5 / 3, 1.0 / 3],
+                                    [1.5 / 3, 0.0, 1.5 / 3],
+                                    [1.0 / 3, 1.5 / 3, 0.0]],
+                                   ids=['sample1', 'sample2', 'sample3'])
+
+        obs = gower_distance_matrix(md)
+
+        self.assertEqual(obs.ids, exp.ids)
+        np.testing.assert_allclose(obs.data, exp.data)
+
+    def test_categorical_only(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'a': ['x', 'y', 'x'], 'b': ['p', 'p', 'q']},
+                         index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                        name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0.0, 0.5, 0.5],
+                                    [0.5, 0.0, 1.0],
+                                    [0.5, 1.0, 0.0]],
+                                   ids=['sample1', 'sample2', 'sample3'])
+
+        obs = gower_distance_matrix(md)
+
+        self.assertEqual(exp, obs)
+
+    def test_missing_values(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'a': ['x', np.nan], 'b': [1.0, 2.0]},
+                         index=pd.Index(['sample1', 'sample2'], name='id'))
+        )
+
+        with self.assertRaisesRegex(ValueError, 'missing values: sample2'):
+            gower_distance_matrix(md)
+
+    def test_drop_missing(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'a': ['x', np.nan, 'y'], 'b': [1.0, 2.0, 3.0]},
+                         index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                        name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0.0, 1.0], [1.0, 0.0]],
+                                   ids=['sample1', 'sample3'])
+
+        obs = gower_distance_matrix(md, missing='drop')
+
+        self.assertEqual(exp, obs)
+
+    def test_pairwise_missing(self):
+        md = qiime2.Metadata(
+            pd.DataFrame({'a': ['x', np.nan, 'y'], 'b': [1.0, 2.0, np.nan],
+                          'c': [0.0, 4.0, 2.0]},
+                         index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                        name='id'))
+        )
+        exp = skbio.DistanceMatrix([[0.0, 2.0 / 2, 1.5 / 2],
+                                    [1.0, 0.0, 0.5 / 1],
+                                    [0.75, 0.5, 0.0]],
+                                   ids=['sample1', 'sample2', 'sample3'])
+
+        obs = gower_distance_matrix(md, missing='pairwise')
+
+        np.testing.assert_allclose(obs.data, exp.data)
+
+
+class HaversineDistanceMatrixTests(unittest.TestCase):
+    def setUp(self):
+        index = pd.Index(['sample1', 'sample2', 'sample3'], name='id')
+        self.latitude = qiime2.NumericMetadataColumn(
+            pd.Series([0.0, 0.0, 90.0], name='lat', index=index))
+        self.longitude = qiime2.NumericMetadataColumn(
+            pd.Series([0.0, 90.0, 0.0], name='lon', index=index))
+
+    def test_quarter_circles(self):
+        quarter = np.pi / 2 * 6371.0088
+
+        obs = haversine_distance_matrix(self.latitude, self.longitude)
+
+        self.assertEqual(obs.ids, ('sample1', 'sample2', 'sample3'))
+        np.testing.assert_allclose(obs.data, [[0.0, quarter, quarter],
+                                              [quarter, 0.0, quarter],
+                                              [quarter, quarter, 0.0]])
+
+    def test_float32_reordered_ids(self):
+        longitude = qiime2.NumericMetadataColumn(
+            pd.Series([0.0, 90.0, 0.0], name='lon',
+                      index=pd.Index(['sample3', 'sample2', 'sample1'],
+                                     name='id')))
+
+        obs = haversine_distance_matrix(self.latitude, longitude,
+                                        precision='float32')
+
+        self.assertEqual(obs.dtype, np.float32)
+        self.assertAlmostEqual(obs['sample1', 'sample2'],
+                               np.pi / 2 * 6371.0088, places=2)
+
+    def test_mismatched_ids(self):
+        longitude = qiime2.NumericMetadataColumn(
+            pd.Series([0.0, 90.0], name='lon',
+                      index=pd.Index(['sample1', 'sample4'], name='id')))
+
+        with self.assertRaisesRegex(ValueError, 'sample2, sample3, sample4'):
+            haversine_distance_matrix(self.latitude, longitude)
+
+    def test_random_coordinates_symmetric(self):
+        rng = np.random.default_rng(0)
+        index = pd.Index(['s%d' % i for i in range(500)], name='id')
+        latitude = qiime2.NumericMetadataColumn(
+            pd.Series(rng.uniform(-90, 90, 500), name='lat', index=index))
+        longitude = qiime2.NumericMetadataColumn(
+            pd.Series(rng.uniform(-180, 180, 500), name='lon', index=index))
+
+        obs = haversine_distance_matrix(latitude, longitude, max_memory=1)
+
+        self.assertTrue((obs.data == obs.data.T).all())
+        self.assertTrue((np.diag(obs.data) == 0).all())
+        # skbio's full validation accepts the matrix
+        skbio.DistanceMatrix(obs.data, ids=obs.ids)
+
+    def test_block_memory(self):
+        rng = np.random.default_rng(0)
+        table = _GeographicTable(rng.uniform(-90, 90, 1000),
+                                 rng.uniform(-180, 180, 1000))
+
+        # 10% slack for row-sized temporaries
+        self.assertLess(_peak_block_memory(table, max_memory=2), 2.2)
+
+    def test_out_of_range(self):
+        latitude = qiime2.NumericMetadataColumn(
+            pd.Series([0.0, 0.0, 91.0], name='lat',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id')))
+
+        with self.assertRaisesRegex(ValueError, 'Latitudes'):
+            haversine_distance_matrix(latitude, self.longitude)
+
+    def test_missing_values(self):
+        longitude = qiime2.NumericMetadataColumn(
+            pd.Series([0.0, np.nan, 0.0], name='lon',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id')))
+
+        with self.assertRaisesRegex(ValueError,
+                                    "'lon'.*missing values: sample2"):
+            haversine_distance_matrix(self.latitude, longitude)
+
+
+class SortedColumnTests(unittest.TestCase):
+    def setUp(self):
+        self.values = np.array([4.0, 1.0, 7.0, 2.0, 2.0])
+        self.column = _SortedColumn(self.values)
+
+    def test_dense(self):
+        exp = np.abs(self.values[:, np.newaxis] - self.values[np.newaxis, :])
+        np.testing.assert_array_equal(self.column.dense(), exp)
+
+    def test_dense_blocked(self):
+        exp = np.abs(self.values[:, np.newaxis] - self.values[np.newaxis, :])
+        with unittest.mock.patch('q2_metadata._distance._block_rows',
+                                 return_value=2):
+            obs = self.column.dense(dtype='float32')
+
+        self.assertEqual(obs.dtype, np.float32)
+        np.testing.assert_array_equal(obs, exp)
+
+    def test_block_rows(self):
+        self.assertEqual(_block_rows(10), 1024)
+        self.assertEqual(_block_rows(2 ** 17, max_memory=1), 1)
+        self.assertEqual(_block_rows(2 ** 20, max_memory=1), 1)
+        self.assertEqual(_block_rows(2 ** 10, max_memory=2), 256)
+        with self.assertRaisesRegex(ValueError, 'at least 1 MB'):
+            _block_rows(10, max_memory=0)
+
+    def test_ranks(self):
+        np.testing.assert_array_equal(self.column.ranks(),
+                                      [4.0, 1.0, 5.0, 2.5, 2.5])
+
+    def test_transform_rank(self):
+        obs = self.column.transform('rank')
+
+        np.testing.assert_array_equal(obs.values, [4.0, 1.0, 5.0, 2.5, 2.5])
+        self.assertIs(obs.order, self.column.order)
+
+    def test_transform_zscore(self):
+        obs = self.column.transform('zscore')
+
+        self.assertAlmostEqual(obs.values.mean(), 0.0)
+        self.assertAlmostEqual(obs.values.std(), 1.0)
+        np.testing.assert_array_equal(np.argsort(obs.values, kind='stable'),
+                                      self.column.order)
+
+    def test_transform_none(self):
+        self.assertIs(self.column.transform('none'), self.column)
+
+    def test_transform_invalid(self):
+        with self.assertRaisesRegex(ValueError, '1 value.*zero or negative'):
+            _SortedColumn([1.0, 0.0]).transform('log')
+        with self.assertRaisesRegex(ValueError, 'all values are equal'):
+            _SortedColumn([2.0, 2.0]).transform('zscore')
+        with self.assertRaisesRegex(ValueError, 'Unknown transform'):
+            self.column.transform('sqrt')
+
+    def test_nearest_neighbors(self):
+        indices, distances = self.column.nearest_neighbors(2)
+
+        np.testing.assert_array_equal(
+            distances, [[2.0, 2.0], [1.0, 1.0], [3.0, 5.0],
+                        [0.0, 1.0], [0.0, 1.0]])
+        self.assertEqual(set(indices[0]), {3, 4})
+        self.assertEqual(set(indices[1]), {3, 4})
+        self.assertEqual(list(indices[2]), [0, 4])
+        self.assertEqual(list(indices[3]), [4, 1])
+        self.assertEqual(list(indices[4]), [3, 1])
+
+    def test_nearest_neighbors_invalid_k(self):
+        with self.assertRaisesRegex(ValueError, 'less than.*5.*5'):
+            self.column.nearest_neighbors(5)
+        with self.assertRaisesRegex(ValueError, 'at least 1'):
+            self.column.nearest_neighbors(0)
+
+    def test_within(self):
+        i, j, distances = self.column.within(1.0)
+        obs = {(frozenset((a, b)), d) for a, b, d in zip(i, j, distances)}
+
+        self.assertEqual(obs, {(frozenset((1, 3)), 1.0),
+                               (frozenset((1, 4)), 1.0),
+                               (frozenset((3, 4)), 0.0)})
+
+    def test_within_negative_radius(self):
+        with self.assertRaisesRegex(ValueError, 'non-negative'):
+            self.column.within(-1.0)
+
+
+class QuantizedColumnTests(unittest.TestCase):
+    def test_codes(self):
+        column = _QuantizedColumn([30.0, 10.0, 25.0], 5.0)
+
+        self.assertEqual(column.codes.dtype, np.uint8)
+        np.testing.assert_array_equal(column.codes, [4, 0, 3])
+
+    def test_uint16_codes(self):
+        column = _QuantizedColumn([0.0, 1000.0], 1.0)
+
+        self.assertEqual(column.codes.dtype, np.uint16)
+        self.assertEqual(column.dense_codes().dtype, np.uint16)
+
+    def test_too_many_levels(self):
+        with self.assertRaisesRegex(ValueError, 'coarser resolution'):
+            _QuantizedColumn([0.0, 70000.0], 1.0)
+
+    def test_invalid_resolution(self):
+        with self.assertRaisesRegex(ValueError, 'must be positive'):
+            _QuantizedColumn([0.0, 1.0], 0.0)
+
+    def test_dense_and_expand(self):
+        column = _QuantizedColumn([30.0, 10.0, 25.0], 5.0)
+        exp = np.array([[0.0, 20.0, 5.0],
+                        [20.0, 0.0, 15.0],
+                        [5.0, 15.0, 0.0]])
+
+        codes = column.dense_codes()
+
+        self.assertEqual(codes.dtype, np.uint8)
+        np.testing.assert_array_equal(codes, exp / 5)
+        np.testing.assert_array_equal(column.dense(), exp)
+        np.testing.assert_array_equal(column.expand(codes, dtype='float32'),
+                                      exp)
+
+
+class GroupedColumnTests(unittest.TestCase):
+    def test_codes(self):
+        column = _GroupedColumn(['b', 'a', 'b', 'c'])
+
+        np.testing.assert_array_equal(column.codes, [0, 1, 0, 2])
+        self.assertEqual(list(column.groups), ['b', 'a', 'c'])
+
+    def test_members(self):
+        column = _GroupedColumn(['b', 'a', 'b', 'c'])
+
+        obs = column.members()
+
+        self.assertEqual(list(obs), ['b', 'a', 'c'])
+        np.testing.assert_array_equal(obs['b'], [0, 2])
+        np.testing.assert_array_equal(obs['a'], [1])
+        np.testing.assert_array_equal(obs['c'], [3])
+
+    def test_block(self):
+        column = _GroupedColumn(['b', 'a', 'b', 'c'])
+
+        np.testing.assert_array_equal(column.block(1, 3),
+                                      [[True, False, True, True],
+                                       [False, True, False, True]])
+
+
+class EngineSymmetryTests(unittest.TestCase):
+    # DistanceMatrix objects are created without skbio's validation, so
+    # every engine must produce exactly symmetric, hollow matrices.
+
+    n = 600
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def random_values(self, *shape, missing=0.0):
+        values = self.rng.lognormal(size=(self.n,) + shape)
+        values[self.rng.random(values.shape) < missing] = np.nan
+        return values
+
+    def assertSymmetricHollow(self, engine):
+        # 1 MB splits these matrices into several blocks.
+        obs = engine.dense(max_memory=1)
+
+        self.assertTrue((obs == obs.T).all())
+        self.assertTrue((np.diag(obs) == 0).all())
+        skbio.DistanceMatrix(obs)
+
+    def test_sorted_column(self):
+        column = _SortedColumn(self.random_values())
+        for transform in _SortedColumn.transforms:
+            with self.subTest(transform=transform):
+                self.assertSymmetricHollow(column.transform(transform))
+
+    def test_quantized_column(self):
+        values = self.rng.integers(0, 300, self.n) * 0.1
+        self.assertSymmetricHollow(_QuantizedColumn(values, 0.1))
+
+    def test_grouped_column(self):
+        values = self.rng.choice(['a', 'b', 'c', 'd'], self.n)
+        self.assertSymmetricHollow(_GroupedColumn(values))
+
+    def test_numeric_table(self):
+        values = self.random_values(4)
+        for metric in _NumericTable.metrics:
+            with self.subTest(metric=metric):
+                self.assertSymmetricHollow(_NumericTable(values, metric))
+        for metric in 'euclidean', 'cosine':
+            with self.subTest(metric=metric, standardize=True):
+                self.assertSymmetricHollow(
+                    _NumericTable(values, metric, standardize=True,
+                                  weights=[0.5, 1.0, 2.0, 0.0]))
+
+    def test_numeric_table_pairwise(self):
+        values = self.random_values(4, missing=0.2)
+        # every pair shares at least one column
+        values[:, 0] = self.rng.lognormal(size=self.n)
+        for metric in 'euclidean', 'manhattan', 'chebyshev', 'cosine':
+            with self.subTest(metric=metric):
+                self.assertSymmetricHollow(
+                    _NumericTable(values, metric,
+                                  weights=[1.0, 0.5, 2.0, 3.0]))
+
+    def test_gower_table(self):
+        categorical = self.rng.choice(['a', 'b', 'c'], (self.n, 2))
+        self.assertSymmetricHollow(
+            _GowerTable(self.random_values(3), categorical))
+
+    def test_gower_table_pairwise(self):
+        numeric = self.random_values(3, missing=0.2)
+        numeric[:, 0] = self.rng.lognormal(size=self.n)
+        categorical = self.rng.choice(['a', 'b', 'c'], (self.n, 2))
+        categorical = categorical.astype(object)
+        categorical[self.rng.random(categorical.shape) < 0.2] = np.nan
+        self.assertSymmetricHollow(_GowerTable(numeric, categorical))
+
+    def test_geographic_table(self):
+        self.assertSymmetricHollow(
+            _GeographicTable(self.rng.uniform(-90, 90, self.n),
+                             self.rng.uniform(-180, 180, self.n)))
+
+
+class EngineMemoryTests(unittest.TestCase):
+    # Blocks are sized from each engine's cell_bytes, so computing a matrix
+    # needs at most about max_memory beyond the matrix itself (with 10%
+    # slack for row-sized temporaries).
+
+    n = 1000
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.values = rng.lognormal(size=(self.n, 4))
+        self.missing = self.values.copy()
+        self.missing[rng.random(self.missing.shape) < 0.2] = np.nan
+        self.missing[:, 0] = self.values[:, 0]
+        self.categorical = rng.choice(['a', 'b'], (self.n, 2)).astype(object)
+
+    def assertWithinBudget(self, engine, max_memory=2):
+        self.assertLess(_peak_block_memory(engine, max_memory),
+                        1.1 * max_memory)
+
+    def test_sorted_column(self):
+        self.assertWithinBudget(_SortedColumn(self.values[:, 0]))
+
+    def test_quantized_column(self):
+        self.assertWithinBudget(
+            _QuantizedColumn(np.arange(self.n) % 300, 1.0))
+
+    def test_numeric_table(self):
+        for metric in _NumericTable.metrics:
+            with self.subTest(metric=metric):
+                self.assertWithinBudget(_NumericTable(self.values, metric))
+
+    def test_numeric_table_pairwise(self):
+        for metric in 'euclidean', 'manhattan', 'chebyshev', 'cosine':
+            with self.subTest(metric=metric):
+                self.assertWithinBudget(_NumericTable(self.missing, metric))
+
+    def test_gower_table(self):
+        self.assertWithinBudget(_GowerTable(self.values, self.categorical))
+
+    def test_gower_table_pairwise(self):
+        categorical = self.categorical.copy()
+        categorical[::7, 1] = np.nan
+        self.assertWithinBudget(_GowerTable(self.missing, categorical))
+
+
 if __name__ == "__main__":
     unittest.main()
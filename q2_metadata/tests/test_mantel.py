@@ -0,0 +1,108 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+import skbio
+import qiime2
+
+from q2_metadata import mantel
+from q2_metadata._mantel import _mantel
+
+
+class MantelTests(unittest.TestCase):
+    def setUp(self):
+        self.ids = ['sample1', 'sample2', 'sample3', 'sample4', 'sample5']
+        self.dm = skbio.DistanceMatrix([[0.0, 1.0, 3.0, 2.0, 7.0],
+                                        [1.0, 0.0, 2.5, 1.0, 5.0],
+                                        [3.0, 2.5, 0.0, 0.5, 4.0],
+                                        [2.0, 1.0, 0.5, 0.0, 6.0],
+                                        [7.0, 5.0, 4.0, 6.0, 0.0]],
+                                       ids=self.ids)
+        self.values = np.array([1.0, 2.0, 4.0, 3.5, 9.0])
+
+    def test_statistic(self):
+        x = skbio.DistanceMatrix(
+            np.abs(self.values[:, np.newaxis] - self.values[np.newaxis, :]))
+        exp = scipy.stats.pearsonr(x.condensed_form(),
+                                   self.dm.condensed_form())[0]
+
+        obs, p_value = _mantel(self.dm.data, self.values, permutations=0)
+
+        self.assertAlmostEqual(obs, exp)
+        self.assertTrue(np.isnan(p_value))
+
+    def test_blocked_statistic(self):
+        exp = _mantel(self.dm.data, self.values, permutations=0)[0]
+
+        with unittest.mock.patch('q2_metadata._mantel._block_rows',
+                                 return_value=2):
+            obs = _mantel(self.dm.data, self.values, permutations=0)[0]
+
+        self.assertAlmostEqual(obs, exp)
+
+    def test_p_value(self):
+        statistic, p_value = _mantel(self.dm.data, self.values,
+                                     permutations=99, random_seed=0)
+
+        self.assertGreater(statistic, 0.9)
+        self.assertLess(p_value, 0.1)
+        self.assertEqual(p_value * 100 % 1, 0)
+
+        _, p_less = _mantel(self.dm.data, self.values, permutations=99,
+                            alternative='less', random_seed=0)
+        self.assertEqual(p_less, 1.0)
+
+    def test_random_seed(self):
+        values = np.array([2.0, 1.0, 4.0, 9.0, 3.5])
+
+        p_values = [_mantel(self.dm.data, values, permutations=99,
+                            random_seed=seed)[1] for seed in (1, 1, 2)]
+
+        self.assertEqual(p_values[0], p_values[1])
+        self.assertNotEqual(p_values[0], p_values[2])
+
+    def test_constant_values(self):
+        with self.assertRaisesRegex(ValueError, 'all equal'):
+            _mantel(self.dm.data, np.ones(5), permutations=0)
+
+    def test_visualizer(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series(np.r_[self.values, 100.0][::-1], name='depth',
+                      index=pd.Index(self.ids[::-1] + ['extra'], name='id'))
+        )
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            mantel(output_dir, self.dm, md, permutations=9)
+
+            self.assertTrue(
+                os.path.exists(os.path.join(output_dir, 'index.html')))
+            result = pd.read_csv(os.path.join(output_dir, 'mantel.tsv'),
+                                 sep='\t', index_col=0)
+            self.assertEqual(result.loc['Sample size'].iloc[0], '5')
+
+    def test_visualizer_missing_ids(self):
+        md = qiime2.NumericMetadataColumn(
+            pd.Series(self.values[:4], name='depth',
+                      index=pd.Index(self.ids[:4], name='id'))
+        )
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            with self.assertRaisesRegex(ValueError,
+                                        'metadata column: sample5'):
+                mantel(output_dir, self.dm, md)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,9 +6,18 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import tempfile
 from unittest import TestCase, main
 
-from q2_metadata.plugin_setup import plugin
+import numpy as np
+import pandas as pd
+import qiime2
+from qiime2.plugin import ValidationError
+
+from q2_metadata import sparse_distance_matrix
+from q2_metadata.plugin_setup import (plugin, SparseDistanceMatrixFormat,
+                                      _3, _4)
 
 
 class PluginTests(TestCase):
@@ -16,5 +25,106 @@ class PluginTests(TestCase):
         self.assertEqual(plugin.name, 'metadata')
 
 
+class SparseDistanceMatrixFormatTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(
+            prefix='q2-metadata-test-temp-')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def format_from(self, text):
+        path = os.path.join(self.temp_dir.name, 'sparse-distance-matrix.tsv')
+        with open(path, 'w') as fh:
+            fh.write(text)
+        return SparseDistanceMatrixFormat(path, mode='r')
+
+    def test_valid(self):
+        ff = self.format_from('id1\tid2\tdistance\n'
+                              's1\ts2\t0.5\n'
+                              's2\ts3\t0\n'
+                              's3\ts1\t1e3\n')
+
+        ff.validate()
+
+    def test_valid_header_only(self):
+        ff = self.format_from('id1\tid2\tdistance\n')
+
+        ff.validate()
+
+    def test_bad_header(self):
+        ff = self.format_from('a\tb\tdistance\n'
+                              's1\ts2\t0.5\n')
+
+        with self.assertRaisesRegex(ValidationError, 'Header must be'):
+            ff.validate()
+
+    def test_wrong_field_count(self):
+        for line in 's1\ts2', 's1\ts2\t0.5\textra':
+            with self.subTest(line=line):
+                ff = self.format_from('id1\tid2\tdistance\n'
+                                      's1\ts3\t0.5\n'
+                                      '%s\n' % line)
+
+                with self.assertRaisesRegex(ValidationError,
+                                            'Line 3 must contain 3'):
+                    ff.validate()
+
+    def test_non_numeric_distance(self):
+        ff = self.format_from('id1\tid2\tdistance\n'
+                              's1\ts2\tfar\n')
+
+        with self.assertRaisesRegex(ValidationError,
+                                    'line 2 is not a number'):
+            ff.validate()
+
+    def test_negative_distance(self):
+        for distance in '-0.5', 'nan':
+            with self.subTest(distance=distance):
+                ff = self.format_from('id1\tid2\tdistance\n'
+                                      's1\ts2\t%s\n' % distance)
+
+                with self.assertRaisesRegex(ValidationError,
+                                            'must be non-negative'):
+                    ff.validate()
+
+
+class SparseDistanceMatrixTransformerTests(TestCase):
+    def setUp(self):
+        self.md = qiime2.NumericMetadataColumn(
+            pd.Series([1.0, 3.0, 7.0], name='number',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id'))
+        )
+
+    def assertRoundTrip(self, df):
+        ff = _3(df)
+        ff.validate()
+        obs = _4(ff)
+
+        self.assertEqual(list(obs.columns), ['id1', 'id2', 'distance'])
+        self.assertEqual(obs['distance'].dtype, np.float64)
+        pd.testing.assert_frame_equal(obs, df, check_dtype=False,
+                                      check_index_type=False)
+
+    def test_round_trip(self):
+        df = sparse_distance_matrix(self.md, n_neighbors=1)
+
+        self.assertRoundTrip(df)
+
+    def test_round_trip_empty(self):
+        df = sparse_distance_matrix(self.md, max_distance=1.0)
+        self.assertTrue(df.empty)
+
+        self.assertRoundTrip(df)
+
+    def test_round_trip_na_like_ids(self):
+        df = pd.DataFrame({'id1': ['NA', 'nan', 'null'],
+                           'id2': ['N/A', 'NA', 'NULL'],
+                           'distance': [1.0, 0.0, 2.5]})
+
+        self.assertRoundTrip(df)
+
+
 if __name__ == "__main__":
     main()
@@ -8,10 +8,12 @@
 
 import unittest
 
+import numpy as np
 import pandas as pd
 import qiime2
 
 from q2_metadata import shuffle_groups
+from q2_metadata._random import _sort_keys
 
 
 class ShuffleGroupsTests(unittest.TestCase):
@@ -268,3 +270,150 @@ class ShuffleGroupsTests(unittest.TestCase):
                          ['fake.group.0.n=2'], 2)
         self.assertEqual(obs['shuffled.grouping.0'].value_counts()
                             ['fake.group.1.n=4'], 4)
+
+    def test_shuffle_groups_many_columns(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'b', 'c', 'a', 'b'], name='groups',
+                      index=pd.Index(['sample1', 'sample2', 'sample3', 's4',
+                                      's5', 's6'],
+                                     name='id'))
+        )
+
+        obs = shuffle_groups(md, n_columns=1000)
+
+        self.assertEqual(obs.shape, (6, 1000))
+        self.assertEqual(list(obs.index), list(md.to_series().index))
+        self.assertEqual(list(obs.columns),
+                         ['shuffled.grouping.%d' % i for i in range(1000)])
+        # every column is a permutation of the same grouping
+        for column_id in obs.columns:
+            self.assertEqual(sorted(obs[column_id]),
+                             ['fake.group.0', 'fake.group.0', 'fake.group.1',
+                              'fake.group.1', 'fake.group.1', 'fake.group.2'])
+        # and the columns are not all identical
+        self.assertGreater(len(obs.T.drop_duplicates()), 1)
+
+    def test_shuffle_groups_invalid_n_columns(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'a'], name='groups',
+                      index=pd.Index(['s1', 's2', 's3'], name='id')))
+
+        for n_columns in 0, -1:
+            with self.assertRaisesRegex(ValueError, 'at least 1'):
+                shuffle_groups(md, n_columns=n_columns)
+
+    def test_shuffle_groups_random_seed(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'b', 'c', 'a', 'b'], name='groups',
+                      index=pd.Index(['sample1', 'sample2', 'sample3', 's4',
+                                      's5', 's6'],
+                                     name='id'))
+        )
+
+        obs1 = shuffle_groups(md, n_columns=50, random_seed=42)
+        obs2 = shuffle_groups(md, n_columns=50, random_seed=42)
+        obs3 = shuffle_groups(md, n_columns=50, random_seed=43)
+
+        pd.testing.assert_frame_equal(obs1, obs2)
+        self.assertFalse(obs1.equals(obs3))
+
+    def test_shuffle_groups_random_seed_column_streams(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'b', 'c', 'a', 'b'], name='groups',
+                      index=pd.Index(['sample1', 'sample2', 'sample3', 's4',
+                                      's5', 's6'],
+                                     name='id'))
+        )
+
+        # the leading columns do not depend on how many columns follow
+        obs1 = shuffle_groups(md, n_columns=5, random_seed=42)
+        obs2 = shuffle_groups(md, n_columns=50, random_seed=42)
+
+        pd.testing.assert_frame_equal(obs1, obs2.iloc[:, :5])
+
+    def test_sort_keys_child_streams(self):
+        keys = _sort_keys(4, 10, random_seed=7)
+        children = np.random.SeedSequence(7).spawn(4)
+
+        # each row can be regenerated on its own from its child seed
+        for row, child in zip(keys, children):
+            np.testing.assert_array_equal(
+                row, np.random.default_rng(child).random(10))
+
+    def test_shuffle_groups_strata(self):
+        index = pd.Index(['s%d' % i for i in range(12)], name='id')
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'c', 'a', 'b', 'c',
+                       'a', 'a', 'b', 'a', 'b', 'b'], name='groups',
+                      index=index)
+        )
+        # strata are interleaved and listed in a different order
+        strata = qiime2.CategoricalMetadataColumn(
+            pd.Series(['x', 'y', 'x', 'y', 'x', 'y',
+                       'z', 'z', 'z', 'z', 'z', 'z'], name='subject',
+                      index=index)
+        )
+        strata_series = strata.to_series()
+
+        obs = shuffle_groups(md, n_columns=200, strata=strata)
+
+        labels = {'a': 'fake.group.0', 'b': 'fake.group.1',
+                  'c': 'fake.group.2'}
+        exp = md.to_series().map(labels)
+        for column_id in obs.columns:
+            for stratum in ('x', 'y', 'z'):
+                members = strata_series.index[strata_series == stratum]
+                self.assertEqual(sorted(obs.loc[members, column_id]),
+                                 sorted(exp[members]))
+        # values are still shuffled within strata
+        self.assertGreater(len(obs.T.drop_duplicates()), 1)
+
+    def test_shuffle_groups_strata_random_seed(self):
+        index = pd.Index(['s%d' % i for i in range(6)], name='id')
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'a', 'b', 'a', 'b'], name='groups',
+                      index=index))
+        strata = qiime2.CategoricalMetadataColumn(
+            pd.Series(['x', 'x', 'x', 'y', 'y', 'y'], name='subject',
+                      index=index))
+
+        obs1 = shuffle_groups(md, n_columns=20, random_seed=3, strata=strata)
+        obs2 = shuffle_groups(md, n_columns=20, random_seed=3, strata=strata)
+
+        pd.testing.assert_frame_equal(obs1, obs2)
+
+    def test_shuffle_groups_strata_single_members(self):
+        index = pd.Index(['s1', 's2', 's3'], name='id')
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'c'], name='groups', index=index))
+        strata = qiime2.CategoricalMetadataColumn(
+            pd.Series(['x', 'y', 'z'], name='subject', index=index))
+
+        obs = shuffle_groups(md, n_columns=10, strata=strata)
+
+        # with one sample per stratum, nothing can move
+        for column_id in obs.columns:
+            self.assertEqual(list(obs[column_id]),
+                             ['fake.group.0', 'fake.group.1',
+                              'fake.group.2'])
+
+    def test_shuffle_groups_strata_missing_ids(self):
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'a'], name='groups',
+                      index=pd.Index(['s1', 's2', 's3'], name='id')))
+        strata = qiime2.CategoricalMetadataColumn(
+            pd.Series(['x', 'y'], name='subject',
+                      index=pd.Index(['s1', 's3'], name='id')))
+
+        with self.assertRaisesRegex(ValueError, 'strata column: s2'):
+            shuffle_groups(md, strata=strata)
+
+    def test_shuffle_groups_strata_missing_values(self):
+        index = pd.Index(['s1', 's2', 's3'], name='id')
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'a'], name='groups', index=index))
+        strata = qiime2.CategoricalMetadataColumn(
+            pd.Series(['x', np.nan, 'x'], name='subject', index=index))
+
+        with self.assertRaisesRegex(ValueError, 'missing values: s2'):
+            shuffle_groups(md, strata=strata)